@@ -0,0 +1,186 @@
+"""
+Helpers shared by the end-to-end benchmarks: the settings sweep, the client
+and server process plumbing, process resource usage and machine-readable
+results.
+"""
+import itertools
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+
+def csv_list(type):
+    "argparse type for comma separated values, e.g. --max-processes 0,2,4"
+    return lambda s: [type(v) for v in s.split(',')]
+
+
+def sweep(run_fn, settings, port, ports_per_run=1, report_fn=None,
+          **kwargs):
+    """
+    Run the benchmark once for every combination of the swept settings.
+
+    Args:
+        run_fn: run_fn(port=..., **setting values, **kwargs) -> run dict
+        settings: list of (name, list of values), the last one varies
+            fastest
+        port: first port, every run gets ports_per_run new ports so that it
+            doesn't wait for the sockets of the previous run
+        report_fn: called with each run dict as soon as it's done
+
+    Returns:
+        list of run dicts
+    """
+    names = [name for name, _ in settings]
+    runs = []
+    for i, values in enumerate(
+            itertools.product(*[values for _, values in settings])):
+        run = run_fn(port=port + ports_per_run * i,
+                     **dict(zip(names, values)), **kwargs)
+        if report_fn is not None:
+            report_fn(run)
+        runs.append(run)
+    return runs
+
+
+def finish_client(client, results, result):
+    """
+    Last call of a client process: wait until everything the client enqueued
+    has been sent, put `result` on the `results` mp.Queue and exit.
+    """
+    # no flush() on the client: wait for the batch thread, then for ZMQ
+    while client.zmqueue.backlog():
+        time.sleep(0.01)
+    time.sleep(0.5)
+    results.put(result)
+    results.close()
+    results.join_thread()  # os._exit() would lose what the feeder holds
+    os._exit(0)  # the batch thread never returns
+
+
+def query(conn, cmd):
+    "send a command to the server process over its Pipe, returns the reply"
+    conn.send(cmd)
+    return conn.recv()
+
+
+def wait_done(conn, expected, progress_fn, idle_time, timeout):
+    """
+    Poll the 'stats' of the server process until it has received `expected`
+    records, has none queued, and has made no progress for idle_time seconds.
+
+    Args:
+        progress_fn: stats -> a value that changes while the server works,
+            e.g. the records taken by the writers
+    Returns:
+        (time of the last progress, last server stats), the stats are None
+        if the server never started
+    """
+    deadline = time.time() + timeout
+    last_progress = None
+    last_change = time.time()
+    stats = None
+    while time.time() < deadline:
+        stats = query(conn, 'stats')
+        now = time.time()
+        if stats is not None:
+            progress = progress_fn(stats)
+            if progress != last_progress:
+                last_progress = progress
+                last_change = now
+            elif (stats['records'] >= expected and stats['queued'] == 0
+                    and now - last_change >= idle_time):
+                return last_change, stats
+        time.sleep(0.02)
+    print('timed out, received {} of {} records'
+          .format(stats and stats['records'], expected), file=sys.stderr)
+    return last_change, stats
+
+
+def self_usage():
+    "CPU seconds and peak RSS of the calling process"
+    ru = resource.getrusage(resource.RUSAGE_SELF)
+    # KB on Linux, bytes on macOS
+    max_rss = ru.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    return {
+        'cpu_sec': ru.ru_utime + ru.ru_stime,
+        'max_rss_mb': max_rss / 2**20,
+    }
+
+
+def pid_usage(pid):
+    """
+    CPU seconds and peak RSS of another live process.
+    Linux only, None elsewhere or if the process is gone.
+    """
+    try:
+        with open('/proc/{}/stat'.format(pid)) as f:
+            # the command name in parentheses may contain spaces
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open('/proc/{}/status'.format(pid)) as f:
+            status = dict(line.split(':', 1) for line in f if ':' in line)
+    except OSError:
+        return None
+    ticks = os.sysconf('SC_CLK_TCK')
+    return {
+        # utime and stime, fields 14 and 15 of proc(5)
+        'cpu_sec': (int(fields[11]) + int(fields[12])) / ticks,
+        'max_rss_mb': int(status['VmHWM'].split()[0]) / 1024,
+    }
+
+
+def pid_io(pid, tid=None):
+    """
+    Bytes written and number of write syscalls so far, of a process or of one
+    of its threads (native id). Linux only, None elsewhere.
+    """
+    if tid is None:
+        path = '/proc/{}/io'.format(pid)
+    else:
+        path = '/proc/{}/task/{}/io'.format(pid, tid)
+    try:
+        with open(path) as f:
+            io = dict(line.split(':', 1) for line in f if ':' in line)
+    except OSError:
+        return None
+    return {
+        'write_bytes': int(io['wchar']),
+        'write_calls': int(io['syscw']),
+    }
+
+
+def _git_commit():
+    repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=repo, stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_results(benchmark, runs, out_path=None):
+    """
+    Print the runs as JSON, tagged with the commit and host so that results
+    can be compared across commits, and save them to out_path if given.
+    """
+    results = {
+        'benchmark': benchmark,
+        'commit': _git_commit(),
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'cpu_count': os.cpu_count(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'runs': runs,
+    }
+    text = json.dumps(results, indent=2)
+    if out_path is None:
+        print(text)
+    else:
+        with open(out_path, 'w') as f:
+            f.write(text + '\n')
+    return results
@@ -0,0 +1,234 @@
+"""
+Loggerplex throughput benchmark.
+
+For every combination of the swept settings, starts a local Loggerplex server
+process and N client processes that each log a fixed number of lines of a
+given size, at a given rate or as fast as they can, with a fraction of them
+being `exception()` calls with a traceback. A run is over when every record
+has been received and the server has stopped writing.
+
+Reports, per run:
+    records/sec written by the server, against the target and achieved client
+        rates. A record is one logging call, its traceback included.
+    server CPU seconds and peak RSS
+    write amplification: bytes in the log files per byte of message, and
+        write syscalls per record of the server dispatch thread (Linux only)
+
+Usage, from the repository root (or with the package installed):
+    PYTHONPATH=. python benchmarks/log_throughput.py --clients 4,16 --rate 0,1000 \\
+        --size 100 --exception-rate 0.01 --out results.json
+"""
+import argparse
+import glob
+import multiprocessing as mp
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from tensorplex import Loggerplex, LoggerplexClient
+from tensorplex.logger import Logger
+from common import (csv_list, sweep, finish_client, query, wait_done,
+                    self_usage, pid_io, write_results)
+
+
+# the server is considered done after this long without writing
+_IDLE_TIME = 0.5
+
+
+def _make_exception(depth):
+    "an exception with a traceback `depth` frames deep"
+    def recurse(n):
+        if n == 0:
+            raise ValueError('synthetic failure')
+        recurse(n - 1)
+    try:
+        recurse(depth)
+    except ValueError as e:
+        return e
+
+
+def _run_client(idx, port, lines, rate, size, exception_rate, traceback_depth,
+                barrier, results):
+    client = LoggerplexClient('client{}'.format(idx),
+                              host='localhost', port=port)
+    msg = 'x' * size
+    exc = _make_exception(traceback_depth)
+    exc_size = len(Logger.exception2str(exc))
+    rng = random.Random(idx)
+    payload_bytes = 0
+    barrier.wait()  # every client is connected
+    start = time.time()
+    for i in range(lines):
+        if rate > 0:
+            delay = start + i / rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        if rng.random() < exception_rate:
+            client.exception(msg, exc=exc)
+            payload_bytes += size + exc_size
+        else:
+            client.info(msg)
+            payload_bytes += size
+    send_time = time.time() - start
+    finish_client(client, results,
+                  (idx, send_time, payload_bytes, self_usage()))
+
+
+def _serve(loggerplex, port, dispatch_tid):
+    dispatch_tid.append(threading.get_native_id())
+    loggerplex.start_server(port)
+
+
+def _run_server(folder, port, conn):
+    loggerplex = Loggerplex(folder)
+    dispatch_tid = []
+    thread = threading.Thread(target=_serve,
+                              args=(loggerplex, port, dispatch_tid))
+    thread.daemon = True
+    thread.start()
+    while True:
+        cmd = conn.recv()
+        if cmd == 'stats':
+            ingest = loggerplex.stats()['ingest']
+            if ingest is None:  # not started yet
+                conn.send(None)
+                continue
+            conn.send({
+                'records': ingest['records'],
+                'bytes': ingest['bytes'],
+                'queued': ingest['queue_depth'],
+                'io': pid_io(os.getpid(), dispatch_tid[0]),
+            })
+        elif cmd == 'usage':
+            conn.send(self_usage())
+        else:  # stop
+            os._exit(0)
+
+
+def _log_bytes(folder):
+    "total size of the log files"
+    return sum(os.path.getsize(path)
+               for path in glob.glob(os.path.join(folder, '*.log')))
+
+
+def _written_bytes(folder, stats):
+    "grows while the server writes"
+    # cheaper than listing the files, and exact on Linux
+    if stats['io'] is not None:
+        return stats['io']['write_bytes']
+    return _log_bytes(folder)
+
+
+def run_one(clients, rate, size, exception_rate, traceback_depth, lines,
+            port, timeout):
+    ctx = mp.get_context('fork')
+    folder = tempfile.mkdtemp(prefix='loggerplex-bench-')
+    conn, server_conn = ctx.Pipe()
+    server = ctx.Process(target=_run_server, args=(folder, port, server_conn))
+    server.start()
+    while query(conn, 'stats') is None:
+        time.sleep(0.01)
+    io_start = query(conn, 'stats')['io']
+    barrier = ctx.Barrier(clients + 1)
+    results = ctx.Queue()
+    procs = [
+        ctx.Process(target=_run_client,
+                    args=(idx, port, lines, rate, size, exception_rate,
+                          traceback_depth, barrier, results))
+        for idx in range(clients)
+    ]
+    for proc in procs:
+        proc.start()
+    barrier.wait()
+    start = time.time()
+    end, stats = wait_done(
+        conn, clients * lines,
+        progress_fn=lambda stats: _written_bytes(folder, stats),
+        idle_time=_IDLE_TIME, timeout=timeout,
+    )
+    client_results = sorted(results.get() for _ in procs)
+    for proc in procs:
+        proc.join()
+    server_usage = query(conn, 'usage')
+    conn.send('stop')
+    server.join()
+    file_bytes = _log_bytes(folder)
+    shutil.rmtree(folder, ignore_errors=True)
+
+    elapsed = end - start
+    records = stats and stats['records']
+    payload_bytes = sum(r[2] for r in client_results)
+    max_send_time = max(r[1] for r in client_results)
+    run = {
+        'clients': clients,
+        'rate_per_client': rate,
+        'size': size,
+        'exception_rate': exception_rate,
+        'records_sent': clients * lines,
+        'records_received': records,
+        'elapsed_sec': elapsed,
+        'records_per_sec': records and records / elapsed,
+        'target_records_per_sec': clients * rate if rate > 0 else None,
+        'client_records_per_sec': clients * lines / max_send_time,
+        'payload_bytes': payload_bytes,
+        'wire_bytes': stats and stats['bytes'],
+        'file_bytes': file_bytes,
+        'write_amplification': file_bytes / max(payload_bytes, 1),
+        'server_usage': server_usage,
+        'client_usage': [r[3] for r in client_results],
+    }
+    if stats and stats['io'] is not None and io_start is not None:
+        write_calls = stats['io']['write_calls'] - io_start['write_calls']
+        run['write_calls'] = write_calls
+        run['write_calls_per_record'] = write_calls / max(records, 1)
+    return run
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--clients', type=csv_list(int), default=[4])
+    parser.add_argument('--rate', type=csv_list(float), default=[0.],
+                        help='records/sec per client, 0 for as fast as '
+                             'possible')
+    parser.add_argument('--size', type=csv_list(int), default=[100],
+                        help='characters per message')
+    parser.add_argument('--exception-rate', type=float, default=0.,
+                        help='fraction of the calls that log a traceback')
+    parser.add_argument('--traceback-depth', type=int, default=10)
+    parser.add_argument('--lines', type=int, default=10000,
+                        help='logging calls per client')
+    parser.add_argument('--port', type=int, default=18200)
+    parser.add_argument('--timeout', type=float, default=300.,
+                        help='max seconds per run')
+    parser.add_argument('--out', default=None, help='JSON file, else stdout')
+    args = parser.parse_args()
+
+    def report(run):
+        print('clients {:<4} rate {:<7} size {:<6} {:10.0f} records/s  '
+              'server cpu {:.2f}s  amplification {:.2f}'
+              .format(run['clients'], run['rate_per_client'], run['size'],
+                      run['records_per_sec'] or 0,
+                      run['server_usage']['cpu_sec'],
+                      run['write_amplification']),
+              file=sys.stderr)
+
+    runs = sweep(
+        run_one,
+        [('clients', args.clients),
+         ('rate', args.rate),
+         ('size', args.size)],
+        port=args.port,
+        report_fn=report,
+        exception_rate=args.exception_rate,
+        traceback_depth=args.traceback_depth,
+        lines=args.lines,
+        timeout=args.timeout,
+    )
+    write_results('log_throughput', runs, args.out)
+
+
+if __name__ == '__main__':
+    main()
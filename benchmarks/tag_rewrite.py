@@ -0,0 +1,59 @@
+"""
+Microbenchmark: per-event cost of tag rewriting in the writer process.
+
+Compares the memoized _Writer._rewrite_tag() with the uncached computation,
+and measures the full _Writer.process() path for add_scalar.
+
+Usage: python benchmarks/tag_rewrite.py [--n 200000]
+"""
+import argparse
+import tempfile
+import timeit
+from tensorplex.local_tensorplex import _Writer
+
+
+TAGS = [
+    ('.my#section/foo', ('agent', '8-15')),
+    (':my.section/bar', ('agent', '8-15')),
+    ('cos', ('agent', '8-15')),
+    ('loss', 'system'),
+    (':learning:rate/eps', 'system'),
+]
+
+
+def bench(label, func, n):
+    seconds = min(timeit.repeat(func, number=n, repeat=3))
+    print('{:<28s} {:8.3f} us/event'.format(label, seconds / n * 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n', type=int, default=200000)
+    args = parser.parse_args()
+    n = args.n
+
+    with tempfile.TemporaryDirectory() as root:
+        writer = _Writer(root, 'bench')
+        i = iter(range(10**12))
+
+        def uncached():
+            tag, client_tag = TAGS[next(i) % len(TAGS)]
+            writer._compute_tag(tag, client_tag)
+
+        def cached():
+            tag, client_tag = TAGS[next(i) % len(TAGS)]
+            writer._rewrite_tag(tag, client_tag)
+
+        def process():
+            step = next(i)
+            tag, client_tag = TAGS[step % len(TAGS)]
+            writer.process('add_scalar', client_tag, (tag, 0.5, step), {})
+
+        bench('rewrite tag (uncached)', uncached, n)
+        bench('rewrite tag (memoized)', cached, n)
+        bench('_Writer.process add_scalar', process, n // 10)
+        writer.writer.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,256 @@
+"""
+End-to-end throughput benchmark.
+
+For every combination of the swept settings, starts a local Tensorplex server
+process, optionally a relay, and N client processes that send a fixed number
+of records each as fast as they can. A run is over when every record has been
+received and the writers have gone idle.
+
+Reports, per run:
+    records/sec and bytes/sec, from the start of the clients to the last
+        record taken by a writer
+    p50/p90/p99 latency of each stage for the records traced with
+        `trace_rate`, see tensorplex/tracing.py
+    CPU seconds and peak RSS of the server, writer, relay and client
+        processes (writer and relay usage on Linux only)
+
+The 'text' payload sends add_text records of ~100 characters, the Tensorplex
+counterpart of log lines. Loggerplex has its own benchmark, log_throughput.py.
+
+Usage, from the repository root (or with the package installed):
+    PYTHONPATH=. python benchmarks/throughput.py --payload scalar,image \\
+        --max-processes 0,4 --transport direct,relay --out results.json
+"""
+import argparse
+import multiprocessing as mp
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import numpy as np
+from tensorplex import Tensorplex, TensorplexClient, start_relay
+from common import (csv_list, sweep, finish_client, query, wait_done,
+                    self_usage, pid_usage, write_results)
+
+
+PAYLOADS = ['scalar', 'histogram', 'image', 'text']
+TRANSPORTS = ['direct', 'relay', 'relay_zlib']
+# records per client, unless --records
+DEFAULT_RECORDS = {
+    'scalar': 20000,
+    'histogram': 2000,
+    'image': 500,
+    'text': 20000,
+}
+# writers are considered idle after this long without taking a record
+_IDLE_TIME = 0.5
+
+
+def _make_send_fn(client, payload):
+    "returns step -> None, sends one record"
+    if payload == 'scalar':
+        return lambda step: client.add_scalar('loss', float(step), step)
+    elif payload == 'histogram':
+        values = np.random.randn(1000)
+        return lambda step: client.add_histogram('weights', values, step)
+    elif payload == 'image':
+        image = np.random.randint(0, 256, (3, 64, 64), dtype=np.uint8)
+        return lambda step: client.add_image('frame', image, step)
+    elif payload == 'text':
+        line = 'step {} ' + 'x' * 100
+        return lambda step: client.add_text('log', line.format(step), step)
+    else:
+        raise ValueError('payload must be one of {}'.format(PAYLOADS))
+
+
+def _run_client(idx, port, payload, records, flush_time, trace_rate,
+                barrier, results):
+    client = TensorplexClient(
+        'bench/{}'.format(idx),
+        host='localhost',
+        port=port,
+        flush_time=flush_time,
+        trace_rate=trace_rate,
+    )
+    send = _make_send_fn(client, payload)
+    barrier.wait()  # every client is connected
+    start = time.time()
+    for step in range(records):
+        send(step)
+    send_time = time.time() - start
+    finish_client(client, results, (idx, send_time, self_usage()))
+
+
+def _server_stats(tplex):
+    stats = tplex.stats()
+    ingest, writers = stats['ingest'], stats['writers']
+    if ingest is None:  # not started yet
+        return None
+    return {
+        'records': ingest['records'],
+        'bytes': ingest['bytes'],
+        'taken': sum(sum(writer['taken']) for writer in writers),
+        'queued': ingest['queue_depth'] + sum(
+            sum(writer['queue_depth']) for writer in writers
+            if writer['queue_depth'] is not None
+        ),
+    }
+
+
+def _server_usage(tplex):
+    usage = {'server': self_usage()}
+    for idx, writer in enumerate(tplex.stats()['writers']):
+        if writer['pid'] is not None:  # process mode
+            usage['writer{}'.format(idx)] = pid_usage(writer['pid'])
+    return usage
+
+
+def _run_server(root, port, max_processes, conn):
+    # the benchmark reads the trace percentiles, don't log them
+    tplex = Tensorplex(root, max_processes=max_processes, log_traces=False)
+    tplex.register_indexed_group('bench', bin_size=1)  # a writer per client
+    thread = threading.Thread(target=tplex.start_server, args=(port,))
+    thread.daemon = True
+    thread.start()
+    while True:
+        cmd = conn.recv()
+        if cmd == 'stats':
+            conn.send(_server_stats(tplex))
+        elif cmd == 'latency':
+            conn.send(tplex.pop_trace_percentiles())
+        elif cmd == 'usage':
+            conn.send(_server_usage(tplex))
+        else:  # stop
+            for proc in mp.active_children():  # writer processes
+                proc.terminate()
+            # skip the exit handlers, tensorboardX threads may still be busy
+            os._exit(0)
+
+
+def run_one(payload, flush_time, max_processes, transport, clients, records,
+            trace_rate, port, timeout):
+    records = records or DEFAULT_RECORDS[payload]
+    ctx = mp.get_context('fork')
+    root = tempfile.mkdtemp(prefix='tensorplex-bench-')
+    conn, server_conn = ctx.Pipe()
+    server = ctx.Process(target=_run_server,
+                         args=(root, port, max_processes, server_conn))
+    server.start()
+    relay = None
+    client_port = port
+    if transport != 'direct':
+        client_port = port + 1
+        relay = ctx.Process(
+            target=start_relay,
+            args=(client_port, 'localhost', port),
+            kwargs={'compress': transport == 'relay_zlib'},
+        )
+        relay.daemon = True
+        relay.start()
+    barrier = ctx.Barrier(clients + 1)
+    results = ctx.Queue()
+    procs = [
+        ctx.Process(target=_run_client,
+                    args=(idx, client_port, payload, records, flush_time,
+                          trace_rate, barrier, results))
+        for idx in range(clients)
+    ]
+    for proc in procs:
+        proc.start()
+    barrier.wait()
+    start = time.time()
+    end, stats = wait_done(conn, clients * records,
+                           progress_fn=lambda stats: stats['taken'],
+                           idle_time=_IDLE_TIME, timeout=timeout)
+    client_results = sorted(results.get() for _ in procs)
+    for proc in procs:
+        proc.join()
+    time.sleep(1.5)  # traces are collected once per second
+    latency = query(conn, 'latency')
+    usage = query(conn, 'usage')
+    if relay is not None:
+        usage['relay'] = pid_usage(relay.pid)
+        relay.terminate()
+    for idx, send_time, client_usage in client_results:
+        usage['client{}'.format(idx)] = client_usage
+    conn.send('stop')
+    server.join()
+    shutil.rmtree(root, ignore_errors=True)
+
+    elapsed = end - start
+    return {
+        'payload': payload,
+        'flush_time': flush_time,
+        'max_processes': max_processes,
+        'transport': transport,
+        'clients': clients,
+        'records_sent': clients * records,
+        'records_received': stats and stats['records'],
+        'elapsed_sec': elapsed,
+        'records_per_sec': stats and stats['records'] / elapsed,
+        'bytes_per_sec': stats and stats['bytes'] / elapsed,
+        'max_client_send_sec': max(r[1] for r in client_results),
+        'latency_p50': latency.get('total', [None] * 3)[0],
+        'latency_p99': latency.get('total', [None] * 3)[2],
+        'latency_stages': {
+            name: dict(zip(['p50', 'p90', 'p99'], values))
+            for name, values in latency.items()
+        },
+        'usage': usage,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--payload', type=csv_list(str), default=['scalar'],
+                        help='comma separated, among ' + ','.join(PAYLOADS))
+    parser.add_argument('--flush-time', type=csv_list(float), default=[0.2],
+                        help='client batching period in seconds')
+    parser.add_argument('--max-processes', type=csv_list(int), default=[2],
+                        help='writer processes, 0 for a writer thread')
+    parser.add_argument('--transport', type=csv_list(str), default=['direct'],
+                        help='comma separated, among ' + ','.join(TRANSPORTS))
+    parser.add_argument('--clients', type=int, default=4)
+    parser.add_argument('--records', type=int, default=None,
+                        help='per client, default depends on the payload')
+    parser.add_argument('--trace-rate', type=float, default=0.05)
+    parser.add_argument('--port', type=int, default=18100)
+    parser.add_argument('--timeout', type=float, default=300.,
+                        help='max seconds per run')
+    parser.add_argument('--out', default=None, help='JSON file, else stdout')
+    args = parser.parse_args()
+    for payload in args.payload:
+        assert payload in PAYLOADS, 'unknown payload ' + payload
+    for transport in args.transport:
+        assert transport in TRANSPORTS, 'unknown transport ' + transport
+
+    def report(run):
+        latency = ['-' if v is None else '{:.3f}s'.format(v)
+                   for v in (run['latency_p50'], run['latency_p99'])]
+        print('{:<10s} flush {:<4} procs {:<2} {:<10s} {:10.0f} records/s '
+              'p50 {} p99 {}'.format(
+                  run['payload'], run['flush_time'], run['max_processes'],
+                  run['transport'], run['records_per_sec'] or 0, *latency),
+              file=sys.stderr)
+
+    runs = sweep(
+        run_one,
+        [('payload', args.payload),
+         ('flush_time', args.flush_time),
+         ('max_processes', args.max_processes),
+         ('transport', args.transport)],
+        port=args.port,
+        ports_per_run=2,  # server and relay
+        report_fn=report,
+        clients=args.clients,
+        records=args.records,
+        trace_rate=args.trace_rate,
+        timeout=args.timeout,
+    )
+    write_results('throughput', runs, args.out)
+
+
+if __name__ == '__main__':
+    main()
@@ -27,6 +27,12 @@ setup(
         "Programming Language :: Python :: 3"
     ],
     python_requires='>=3.5',
+    entry_points={
+        'console_scripts': [
+            'tensorplex-relay=tensorplex.relay:main',
+            'tensorplex-loadgen=tensorplex.loadgen:main',
+        ],
+    },
     include_package_data=True,
     zip_safe=False
 )
@@ -1,2 +1,3 @@
 from .loggerplex import *
 from .tensorplex import *
+from .relay import start_relay
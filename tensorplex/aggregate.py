@@ -0,0 +1,123 @@
+"""
+Cross-member aggregate curves for indexed groups.
+Instead of loading one curve per agent, TensorBoard can show the mean, median,
+10th and 90th percentile across all agents at every step.
+"""
+import time
+from collections import OrderedDict
+import numpy as np
+
+
+AGGREGATE_STATS = ['mean', 'median', 'p10', 'p90']
+
+
+def reduce_values(values):
+    """
+    Returns:
+        {stat name: float} for all AGGREGATE_STATS
+    """
+    values = np.fromiter(values, dtype=np.float64)
+    p10, median, p90 = np.percentile(values, [10, 50, 90])
+    return {
+        'mean': float(values.mean()),
+        'median': float(median),
+        'p10': float(p10),
+        'p90': float(p90),
+    }
+
+
+class StepAggregator(object):
+    """
+    Streaming per-step reducer across all members of one indexed group.
+
+    Values are buffered per (tag, step). A step is reduced and emitted when
+    `window` seconds have passed since its first value, or earlier as soon as
+    every known member has reported it. The early exit is only trusted once no
+    new member has joined for `window` seconds, so that the first steps of a
+    run are not reduced over the handful of members that happen to connect
+    first. Late values for a step that has already been reduced are dropped,
+    steps can otherwise arrive in any order.
+    Memory is bounded by the number of steps in flight within the window,
+    plus the last `max_reduced` reduced (tag, step) keys. A value that comes
+    after its key has left that window starts a new reduction of the step.
+    """
+    def __init__(self, window, max_reduced=100000, on_drop=None):
+        """
+        Args:
+            window: max seconds to wait for the stragglers of a step
+            max_reduced: number of reduced (tag, step) keys remembered to
+                recognize late values
+            on_drop: callback(member, tag) for every late value dropped
+        """
+        self._window = window
+        self._max_reduced = max_reduced
+        self._on_drop = on_drop
+        self._members = set()
+        self._members_stable_time = 0.
+        # (tag, step): (deadline, {member: value}), in insertion order
+        self._pending = OrderedDict()
+        self._reduced = OrderedDict()  # (tag, step): None, oldest first
+
+    def add(self, member, tag, step, value, now=None):
+        """
+        Returns:
+            list of completed (tag, step, stats dict)
+        """
+        if now is None:
+            now = time.time()
+        if member not in self._members:
+            self._members.add(member)
+            self._members_stable_time = now + self._window
+        key = (tag, step)
+        completed = []
+        if key in self._pending:
+            values = self._pending[key][1]
+        elif key in self._reduced:
+            values = None  # too late, already reduced
+            if self._on_drop is not None:
+                self._on_drop(member, tag)
+        else:
+            values = {}
+            self._pending[key] = (now + self._window, values)
+        if values is not None:
+            values[member] = value
+            if (now >= self._members_stable_time
+                    and len(values) >= len(self._members)):
+                del self._pending[key]
+                completed.append(self._reduce(tag, step, values))
+        completed.extend(self.expire(now))
+        return completed
+
+    def _reduce(self, tag, step, values):
+        self._reduced[tag, step] = None
+        if len(self._reduced) > self._max_reduced:
+            self._reduced.popitem(last=False)
+        return tag, step, reduce_values(values.values())
+
+    def expire(self, now=None):
+        """
+        Returns:
+            list of (tag, step, stats dict) whose window has passed
+        """
+        if now is None:
+            now = time.time()
+        expired = []
+        # insertion order: the oldest deadlines come first
+        for key, (deadline, _) in self._pending.items():
+            if deadline > now:
+                break
+            expired.append(key)
+        completed = []
+        for key in expired:
+            _, values = self._pending.pop(key)
+            completed.append(self._reduce(key[0], key[1], values))
+        return completed
+
+    def flush(self):
+        "reduce all the pending steps right away, even if incomplete"
+        completed = [
+            self._reduce(tag, step, values)
+            for (tag, step), (_, values) in self._pending.items()
+        ]
+        self._pending.clear()
+        return completed
@@ -0,0 +1,404 @@
+"""
+Bounded queue with per-record-kind overflow policies, priority lanes,
+and drop accounting.
+"""
+import itertools
+import os
+import queue
+import threading
+from collections import deque, Counter
+
+
+OVERFLOW_POLICIES = ['block', 'drop_oldest', 'drop_newest', 'drop_low_priority']
+
+# higher is more important, used by 'drop_low_priority'
+# unknown kinds default to the highest priority
+RECORD_PRIORITY = {
+    'add_scalar': 2,
+    'add_scalars': 2,
+    'add_scalar_array': 2,
+    'add_text': 2,
+    'add_histogram': 1,
+    'add_histogram_raw': 1,
+    'add_image': 0,
+    'add_audio': 0,
+    'add_embedding': 0,
+    'add_encoded_summary': 0,
+}
+
+
+# priority lanes: cheap records are scheduled ahead of heavy tensor records,
+# so that a burst of images doesn't delay the scalars queued behind it
+FAST_LANE = 0
+HEAVY_LANE = 1
+NUM_LANES = 2
+LANE_NAMES = ['fast', 'heavy']
+FAST_METHODS = {
+    'add_scalar',
+    'add_scalars',
+    'add_scalar_array',
+    'add_text',
+    'add_histogram_raw',
+}
+
+
+def record_lane(method_name):
+    """
+    Returns:
+        FAST_LANE or HEAVY_LANE for data records ('add_*'),
+        None for everything else (export, control messages), which are
+        barriers across all lanes
+    """
+    if method_name is None or not method_name.startswith('add_'):
+        return None
+    if method_name in FAST_METHODS:
+        return FAST_LANE
+    return HEAVY_LANE
+
+
+def check_overflow_policy(overflow_policy):
+    """
+    Args:
+        overflow_policy: policy str, or dict {record kind: policy str}
+    """
+    if isinstance(overflow_policy, dict):
+        policies = overflow_policy.values()
+    else:
+        policies = [overflow_policy]
+    for policy in policies:
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError('overflow policy must be one of {}, got "{}"'
+                             .format(OVERFLOW_POLICIES, policy))
+
+
+def get_overflow_policy(overflow_policy, kind):
+    """
+    Only data records ('add_*') can be dropped, everything else (export,
+    control messages) always blocks.
+    """
+    if kind is None or not kind.startswith('add_'):
+        return 'block'
+    if isinstance(overflow_policy, dict):
+        return overflow_policy.get(kind, 'block')
+    return overflow_policy
+
+
+_barrier_keys = itertools.count()
+
+
+class Barrier(object):
+    """
+    An item queued on every lane, see DropQueue. All the copies of a barrier
+    share its key, also once pickled to another process.
+    """
+    __slots__ = ['item', 'key']
+
+    def __init__(self, item):
+        self.item = item
+        self.key = (os.getpid(), next(_barrier_keys))
+
+
+class _Entry(object):
+    "a queued item of a DropQueue that can evict, see _evict()"
+    __slots__ = ['item', 'kind', 'seq', 'evicted']
+
+    def __init__(self, item, kind, seq):
+        self.item = item
+        self.kind = kind
+        self.seq = seq
+        self.evicted = False
+
+
+class DropQueue(object):
+    """
+    Thread-safe bounded FIFO. When full, what happens to a new item depends on
+    the policy of its kind:
+    - block: wait for a free slot
+    - drop_newest: discard the new item
+    - drop_oldest: evict the oldest queued item of the same kind, or discard
+        the new item if there is none
+    - drop_low_priority: evict the oldest queued item with a lower priority
+        (e.g. an image to make room for a scalar), or discard the new item
+        if there is none
+
+    Items whose kind is None always block. Evictions take constant time in
+    the queue length: with a policy that evicts, every lane also keeps a
+    FIFO of its items per kind, and an evicted item is left in its lane
+    until it reaches the front.
+
+    With `lane_fn`, items are split into NUM_LANES FIFO lanes, each bounded by
+    `maxsize`. get() serves the lowest-numbered non-empty lane first, except
+    that a lane passed over `starvation_limit` times in a row is served next.
+    Items for which `lane_fn` returns None are barriers: they are queued on
+    every lane and only come out once everything queued before them on every
+    lane is out, which preserves the ordering of e.g. exports with respect to
+    all the records before them. Barriers never count towards `maxsize`.
+    A Barrier put lane by lane keeps that ordering as long as its copies
+    don't cross those of another barrier, e.g. when producers hold a common
+    lock until they have put every copy. Otherwise, if the lanes are all held
+    up by different barriers, the one on the first lane is served right away
+    and its other copies are skipped when they come up: a record is still
+    never served before a barrier that precedes it on its own lane, but that
+    barrier can come out before records queued ahead of its copies on the
+    other lanes.
+
+    Implements the subset of the `queue.Queue` interface used by tensorplex.
+    """
+    def __init__(self, maxsize, kind_fn,
+                 overflow_policy='block',
+                 priorities=None,
+                 on_drop=None,
+                 lane_fn=None,
+                 starvation_limit=8,
+                 taken=None):
+        """
+        Args:
+            maxsize: <= 0 for unbounded
+            kind_fn: item -> kind str, e.g. the method name of the record
+            overflow_policy: policy str, or dict {kind: policy str}
+            priorities: dict {kind: int}, defaults to RECORD_PRIORITY
+            on_drop: callback(item) for every discarded or evicted item
+            lane_fn: item -> lane index or None for a barrier, e.g.
+                `record_lane()` of the method name. None for a single lane.
+            starvation_limit: max number of times in a row a non-empty lane
+                can be passed over in favor of a faster one
+            taken: array of the number of items taken from each lane so far,
+                updated in place, e.g. a shared array. Defaults to a list,
+                see `taken`.
+        """
+        check_overflow_policy(overflow_policy)
+        self.maxsize = maxsize
+        self._kind_fn = kind_fn
+        self._overflow_policy = overflow_policy
+        self._priorities = RECORD_PRIORITY if priorities is None else priorities
+        self._on_drop = on_drop
+        self._lane_fn = lane_fn
+        self._starvation_limit = starvation_limit
+        num_lanes = 1 if lane_fn is None else NUM_LANES
+        self._lanes = [deque() for _ in range(num_lanes)]
+        if isinstance(overflow_policy, dict):
+            policies = overflow_policy.values()
+        else:
+            policies = [overflow_policy]
+        if maxsize > 0 and any(policy in ['drop_oldest', 'drop_low_priority']
+                               for policy in policies):
+            # per lane: {kind: deque of _Entry}, in the order of the lane
+            self._kind_queues = [{} for _ in range(num_lanes)]
+        else:
+            self._kind_queues = None
+        self._seq = itertools.count()
+        self._evicted = [0] * num_lanes  # evicted entries still in each lane
+        self._skipped = [0] * num_lanes  # times passed over in a row
+        # barrier key: number of copies left to skip, see _pop()
+        self._served_early = {}
+        if taken is None:
+            taken = [0] * num_lanes
+        self.taken = taken
+        self._size = 0  # number of entries, a barrier counts once per lane
+        self._mutex = threading.Lock()
+        self._not_empty = threading.Condition(self._mutex)
+        self._not_full = threading.Condition(self._mutex)
+
+    def _priority(self, kind):
+        return self._priorities.get(kind, max(self._priorities.values()))
+
+    def _lane_size(self, lane):
+        return len(self._lanes[lane]) - self._evicted[lane]
+
+    def _evict(self, lane, kinds):
+        """
+        Remove the oldest queued item of the lane among the given kinds.
+        The oldest item of every kind is at the front of its FIFO.
+        """
+        kind_queues = self._kind_queues[lane]
+        oldest = None
+        for kind in kinds:
+            entries = kind_queues.get(kind)
+            if entries and (oldest is None or entries[0].seq < oldest.seq):
+                oldest = entries[0]
+        if oldest is None:
+            return None
+        kind_queues[oldest.kind].popleft()
+        oldest.evicted = True
+        self._evicted[lane] += 1
+        self._skip_evicted(lane)
+        return oldest.item
+
+    def _skip_evicted(self, lane):
+        "so that the front of a lane is never an evicted entry"
+        q = self._lanes[lane]
+        while q and type(q[0]) is _Entry and q[0].evicted:
+            q.popleft()
+            self._evicted[lane] -= 1
+
+    def put(self, item, block=True, timeout=None, lane=None):
+        """
+        Args:
+            lane: put on this lane, bypassing `lane_fn`. A barrier must be
+                put as a Barrier, on every lane.
+
+        Returns:
+            False if the item was dropped
+        """
+        is_barrier = False
+        if isinstance(item, Barrier):  # one copy
+            assert lane is not None, 'a Barrier must be put on a given lane'
+        elif lane is None:
+            if self._lane_fn is None:
+                lane = 0
+            else:
+                lane = self._lane_fn(item)
+                is_barrier = lane is None
+        dropped = None
+        with self._not_full:
+            if is_barrier:
+                barrier = Barrier(item)
+                for q in self._lanes:
+                    q.append(barrier)
+                self._size += len(self._lanes)
+                self._not_empty.notify()
+                return True
+            q = self._lanes[lane]
+            is_copy = isinstance(item, Barrier)
+            full = 0 < self.maxsize <= self._lane_size(lane) and not is_copy
+            indexed = self._kind_queues is not None and not is_copy
+            if full or indexed:
+                kind = self._kind_fn(item)
+            if full:
+                policy = get_overflow_policy(self._overflow_policy, kind)
+                if policy == 'block':
+                    if not block:
+                        raise queue.Full
+                    while self._lane_size(lane) >= self.maxsize:
+                        if not self._not_full.wait(timeout):
+                            raise queue.Full
+                elif policy == 'drop_newest':
+                    dropped = item
+                elif policy == 'drop_oldest':
+                    dropped = self._evict(lane, [kind])
+                else:  # drop_low_priority
+                    priority = self._priority(kind)
+                    dropped = self._evict(lane, [
+                        k for k in self._kind_queues[lane]
+                        if self._priority(k) < priority
+                    ])
+                if dropped is None:  # nothing to evict
+                    if policy != 'block':
+                        dropped = item
+            if dropped is not item:
+                if indexed:
+                    entry = _Entry(item, kind, next(self._seq))
+                    kind_queues = self._kind_queues[lane]
+                    if kind not in kind_queues:
+                        kind_queues[kind] = deque()
+                    kind_queues[kind].append(entry)
+                    q.append(entry)
+                else:
+                    q.append(item)
+                if dropped is None:
+                    self._size += 1
+                self._not_empty.notify()
+        if dropped is not None and self._on_drop is not None:
+            self._on_drop(dropped)
+        return dropped is not item
+
+    def _take(self, lane):
+        self._size -= 1
+        self.taken[lane] += 1
+        item = self._lanes[lane].popleft()
+        if type(item) is _Entry:
+            self._kind_queues[lane][item.kind].popleft()
+            item = item.item
+        if self._evicted[lane]:
+            self._skip_evicted(lane)
+        return item
+
+    def _pop(self):
+        """
+        Returns:
+            the next item according to the lane schedule, or None if nothing
+            can be served yet
+        """
+        lanes = self._lanes
+        if len(lanes) == 1:
+            return self._take(0) if lanes[0] else None
+        served_early = self._served_early
+        if served_early:
+            for i, q in enumerate(lanes):
+                while (q and isinstance(q[0], Barrier)
+                        and q[0].key in served_early):
+                    key = self._take(i).key
+                    served_early[key] -= 1
+                    if not served_early[key]:
+                        del served_early[key]
+        ready = [i for i, q in enumerate(lanes)
+                 if q and not isinstance(q[0], Barrier)]
+        if not ready:
+            if not all(lanes):  # wait for the other copies
+                return None
+            key = lanes[0][0].key
+            if all(q[0].key == key for q in lanes):
+                for i in range(len(lanes)):
+                    barrier = self._take(i)
+                return barrier.item
+            # different barriers hold up every lane
+            served_early[key] = len(lanes) - 1
+            return self._take(0).item
+        served = ready[0]
+        for i in ready[1:]:
+            if self._skipped[i] >= self._starvation_limit:
+                served = i
+                break
+        for i in ready:
+            self._skipped[i] = 0 if i == served else self._skipped[i] + 1
+        return self._take(served)
+
+    def get(self, block=True, timeout=None):
+        with self._not_empty:
+            item = self._pop()
+            if item is None:
+                if not block:
+                    raise queue.Empty
+                while item is None:
+                    if not self._not_empty.wait(timeout):
+                        raise queue.Empty
+                    item = self._pop()
+            self._not_full.notify_all()
+            return item
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def qsize(self):
+        return self._size
+
+    def lane_sizes(self):
+        "number of queued items in each lane, barriers included"
+        return [self._lane_size(lane) for lane in range(len(self._lanes))]
+
+
+class DropCounter(object):
+    """
+    Thread-safe counter of dropped records, per (client, tag).
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = Counter()
+        self._total = 0
+
+    def count(self, client, tag):
+        with self._lock:
+            self._counts[client, tag] += 1
+            self._total += 1
+
+    @property
+    def total(self):
+        return self._total
+
+    def snapshot(self):
+        """
+        Returns:
+            {(client, tag): cumulative drop count}
+        """
+        with self._lock:
+            return dict(self._counts)
@@ -0,0 +1,238 @@
+"""
+Columnar export of the scalars logged by a single _Writer.
+
+The exporters read back the tfevents files in the writer folder instead of
+keeping every scalar in memory, so the writer process stays flat no matter how
+long the run is. Records are streamed in chunks of `chunk_size` rows.
+
+Columns: writer (str), tag (str), step (int64), wall_time (float64),
+value (float64)
+"""
+import glob
+import json
+import os
+import struct
+import tempfile
+import zipfile
+import numpy as np
+from tensorboardX.proto.event_pb2 import Event
+
+
+EXPORT_FORMATS = ['npz', 'parquet']
+
+_NUMERIC_DTYPES = [
+    ('step', np.int64),
+    ('wall_time', np.float64),
+    ('value', np.float64),
+    ('tag', np.int32),  # index into the tag vocabulary until the very end
+]
+
+
+def check_export_format(format):
+    """
+    Fail early (on the main process) rather than in the writer process.
+    """
+    if format not in EXPORT_FORMATS:
+        raise ValueError('export format must be one of {}, got "{}"'
+                         .format(EXPORT_FORMATS, format))
+    if format == 'parquet':
+        try:
+            import pyarrow
+        except ImportError as e:
+            raise ImportError('parquet export requires `pyarrow`. '
+                              'Please `pip install pyarrow`') from e
+
+
+def export_file_name(writerID, format):
+    return writerID.replace('/', '.') + '.' + format
+
+
+def event_files(folder):
+    "all tfevents files in a writer folder, in TensorBoard's loading order"
+    return sorted(glob.glob(os.path.join(folder, 'events.out.tfevents.*')))
+
+
+def iter_event_records(fpath):
+    """
+    Iterate over serialized Event protos in a tfrecord file. A truncated
+    record at the tail (file still being written) is silently ignored.
+    CRCs are not verified for speed.
+    """
+    with open(fpath, 'rb') as f:
+        while True:
+            header = f.read(12)  # uint64 length + uint32 length crc
+            if len(header) < 12:
+                return
+            length, = struct.unpack('<Q', header[:8])
+            data = f.read(length)
+            if len(data) < length or len(f.read(4)) < 4:
+                return
+            yield data
+
+
+def iter_scalars(folder):
+    """
+    Yields:
+        (tag, step, wall_time, value) for every scalar in the writer folder
+    """
+    event = Event()
+    for fpath in event_files(folder):
+        for data in iter_event_records(fpath):
+            event.ParseFromString(data)
+            if not event.HasField('summary'):
+                continue
+            for v in event.summary.value:
+                if v.WhichOneof('value') == 'simple_value':
+                    yield v.tag, event.step, event.wall_time, v.simple_value
+
+
+def iter_scalar_chunks(folder, chunk_size):
+    """
+    Yields:
+        (tag list, step list, wall_time list, value list), each at most
+        `chunk_size` long
+    """
+    chunk = ([], [], [], [])
+    for row in iter_scalars(folder):
+        for col, x in zip(chunk, row):
+            col.append(x)
+        if len(chunk[0]) >= chunk_size:
+            yield chunk
+            chunk = ([], [], [], [])
+    if chunk[0]:
+        yield chunk
+
+
+def export_json(folder, path):
+    """
+    Same format as tensorboardX's export_scalars_to_json(), with every scalar
+    in the event files: {tag: [[wall_time, step, value], ...]}.
+    Unlike the columnar formats, the whole writer is held in memory.
+    """
+    scalars = {}
+    for tag, step, wall_time, value in iter_scalars(folder):
+        scalars.setdefault(tag, []).append([wall_time, step, value])
+    with open(path, 'w') as f:
+        json.dump(scalars, f)
+
+
+def export_npz(folder, path, writerID, chunk_size):
+    """
+    Numeric columns are first spooled to temporary files chunk by chunk, then
+    streamed into the .npz members, so peak memory is O(chunk_size).
+    Load with `np.load(path)`.
+    """
+    tag_vocab = {}  # tag: int code
+    num_rows = 0
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(path)) as tmp_dir:
+        spools = {
+            name: open(os.path.join(tmp_dir, name), 'wb')
+            for name, _ in _NUMERIC_DTYPES
+        }
+        for tags, steps, wall_times, values in \
+                iter_scalar_chunks(folder, chunk_size):
+            codes = [tag_vocab.setdefault(tag, len(tag_vocab)) for tag in tags]
+            for name, col in [('step', steps),
+                              ('wall_time', wall_times),
+                              ('value', values),
+                              ('tag', codes)]:
+                spools[name].write(
+                    np.asarray(col, dtype=dict(_NUMERIC_DTYPES)[name]).tobytes()
+                )
+            num_rows += len(tags)
+        for f in spools.values():
+            f.close()
+
+        vocab = np.array(sorted(tag_vocab, key=tag_vocab.get), dtype=str)
+        if not len(vocab):
+            vocab = np.array([''])
+        with zipfile.ZipFile(path, 'w') as zf:
+            _write_npy_member(
+                zf, 'writer', np.dtype('<U{}'.format(max(len(writerID), 1))),
+                num_rows, chunk_size,
+                lambda n: np.full(n, writerID).tobytes()
+            )
+            _write_npy_member(
+                zf, 'tag', vocab.dtype, num_rows, chunk_size,
+                _SpoolReader(os.path.join(tmp_dir, 'tag'), np.int32,
+                             transform=lambda codes: vocab[codes])
+            )
+            for name, dtype in _NUMERIC_DTYPES[:3]:
+                _write_npy_member(
+                    zf, name, np.dtype(dtype), num_rows, chunk_size,
+                    _SpoolReader(os.path.join(tmp_dir, name), dtype)
+                )
+
+
+class _SpoolReader(object):
+    "callable that reads the next n items of a spooled column as bytes"
+    def __init__(self, spool_path, dtype, transform=None):
+        self.spool_path = spool_path
+        self.dtype = np.dtype(dtype)
+        self.transform = transform
+        self._file = None
+
+    def __call__(self, n):
+        if self._file is None:
+            self._file = open(self.spool_path, 'rb')
+        arr = np.frombuffer(self._file.read(n * self.dtype.itemsize),
+                            dtype=self.dtype)
+        if self.transform is not None:
+            arr = self.transform(arr)
+        return arr.tobytes()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+
+def _write_npy_member(zf, name, dtype, num_rows, chunk_size, read_chunk):
+    header = {
+        'descr': np.lib.format.dtype_to_descr(dtype),
+        'fortran_order': False,
+        'shape': (num_rows,),
+    }
+    with zf.open(name + '.npy', 'w', force_zip64=True) as f:
+        np.lib.format.write_array_header_2_0(f, header)
+        for start in range(0, num_rows, chunk_size):
+            f.write(read_chunk(min(chunk_size, num_rows - start)))
+    if isinstance(read_chunk, _SpoolReader):
+        read_chunk.close()
+
+
+def export_parquet(folder, path, writerID, chunk_size):
+    """
+    Each chunk becomes one parquet row group.
+    Load with `pandas.read_parquet(path)`.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([
+        ('writer', pa.string()),
+        ('tag', pa.string()),
+        ('step', pa.int64()),
+        ('wall_time', pa.float64()),
+        ('value', pa.float64()),
+    ])
+    with pq.ParquetWriter(path, schema) as pq_writer:
+        for tags, steps, wall_times, values in \
+                iter_scalar_chunks(folder, chunk_size):
+            table = pa.Table.from_arrays([
+                pa.array([writerID] * len(tags), pa.string()),
+                pa.array(tags, pa.string()),
+                pa.array(steps, pa.int64()),
+                pa.array(wall_times, pa.float64()),
+                pa.array(values, pa.float64()),
+            ], schema=schema)
+            pq_writer.write_table(table)
+
+
+_EXPORTERS = {
+    'npz': export_npz,
+    'parquet': export_parquet,
+}
+
+
+def export_scalars(folder, path, writerID, format, chunk_size):
+    _EXPORTERS[format](folder, path, writerID, chunk_size)
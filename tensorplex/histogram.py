@@ -0,0 +1,82 @@
+"""
+Client-side histogram precomputation.
+Mirrors tensorboardX's `make_histogram()` so that the server can write the
+HistogramProto directly with `add_histogram_raw()`.
+"""
+import numpy as np
+
+
+_DEFAULT_BINS = None
+
+
+def default_bins():
+    """
+    Same exponential buckets as `SummaryWriter.default_bins`,
+    see generate_testdata.py in tensorflow/tensorboard
+    """
+    global _DEFAULT_BINS
+    if _DEFAULT_BINS is None:
+        v = 1E-12
+        buckets = []
+        neg_buckets = []
+        while v < 1E20:
+            buckets.append(v)
+            neg_buckets.append(-v)
+            v *= 1.1
+        _DEFAULT_BINS = np.array(neg_buckets[::-1] + [0] + buckets)
+    return _DEFAULT_BINS
+
+
+def compute_histogram(values, bins='tensorflow', max_bins=None):
+    """
+    Args:
+        values: array-like of any shape
+        bins: 'tensorflow' or anything accepted by `np.histogram`
+        max_bins: subsample the buckets if there are more than max_bins
+
+    Returns:
+        kwargs dict for `SummaryWriter.add_histogram_raw()`:
+        min, max, num, sum, sum_squares, bucket_limits, bucket_counts
+    """
+    values = np.asarray(values, dtype=np.float64).reshape(-1)
+    if values.size == 0:
+        raise ValueError('The input has no element.')
+    if isinstance(bins, str) and bins == 'tensorflow':
+        bins = default_bins()
+    counts, limits = np.histogram(values, bins=bins)
+    num_bins = len(counts)
+    if max_bins is not None and num_bins > max_bins:
+        subsampling = num_bins // max_bins
+        subsampling_remainder = num_bins % subsampling
+        if subsampling_remainder != 0:
+            counts = np.pad(counts,
+                            pad_width=[[0, subsampling - subsampling_remainder]],
+                            mode='constant', constant_values=0)
+        counts = counts.reshape(-1, subsampling).sum(axis=-1)
+        new_limits = np.empty((counts.size + 1,), limits.dtype)
+        new_limits[:-1] = limits[:-1:subsampling]
+        new_limits[-1] = limits[-1]
+        limits = new_limits
+
+    # only keep the support of the histogram, plus one empty bin on the left
+    # because TensorBoard only includes the right bin limits
+    cum_counts = np.cumsum(np.greater(counts, 0))
+    start, end = np.searchsorted(cum_counts, [0, cum_counts[-1] - 1],
+                                 side='right')
+    start = int(start)
+    end = int(end) + 1
+    if start > 0:
+        counts = counts[start - 1:end]
+    else:
+        counts = np.concatenate([[0], counts[:end]])
+    limits = limits[start:end + 1]
+
+    return {
+        'min': float(values.min()),
+        'max': float(values.max()),
+        'num': int(values.size),
+        'sum': float(values.sum()),
+        'sum_squares': float(values.dot(values)),
+        'bucket_limits': limits.tolist(),
+        'bucket_counts': counts.tolist(),
+    }
@@ -0,0 +1,505 @@
+"""
+Load generator: replays the traffic mix of an RL cluster against a running
+Tensorplex server, and optionally a Loggerplex server, to size the servers
+before a big run.
+
+Simulated clients, each on its own schedule:
+    learner/<i>: normal group, `learner_tags` scalars per step, a histogram
+        every `histogram_every` steps and an image every `image_every` steps
+    agent/<i>: indexed group, `agent_tags` scalars per episode
+    eval/<mode><i>: combined group binned by mode, `eval_tags` scalars per
+        episode
+With --log-port, every client also logs a line to Loggerplex per step or
+episode.
+
+Start a server that registers the same groups, e.g.
+    tensorplex-loadgen serve ~/tmp/loadgen 8008 --log-port 8010
+then replay 4000 agents from 16 processes for 2 minutes:
+    tensorplex-loadgen run localhost 8008 --log-port 8010 --agents 4000 \\
+        --processes 16 --duration 120 --ramp
+
+Every `--interval` seconds, prints the target rate, the rate at which records
+were enqueued and sent, the records waiting in the client buffers and the time
+the client sockets were blocked by the server. Backpressure kicks in when the
+sockets block or the buffers grow. With --ramp, the rates grow linearly up to
+their target over the run, so that the first interval under backpressure gives
+the capacity of the server.
+"""
+import argparse
+import heapq
+import json
+import multiprocessing as mp
+import os
+import random
+import sys
+import time
+import urllib.request
+from collections import Counter
+import numpy as np
+from .tensorplex import TensorplexClient
+from .loggerplex import LoggerplexClient
+
+
+EVAL_MODES = ['deterministic', 'stochastic']
+# an interval is under backpressure if the client sockets were blocked more
+# than this fraction of the time, or if the client buffers hold more than this
+# many seconds worth of records
+_BLOCKED_FRACTION = 0.1
+_BACKLOG_SECONDS = 1.
+
+
+def eval_bin_name(ID):
+    "combined group bin of an eval client, e.g. 'stochastic3' -> ':stochastic'"
+    return ':' + ID.rstrip('0123456789')
+
+
+def _client_specs(args):
+    "list of (role, client ID, events per second)"
+    specs = []
+    for i in range(args.learners):
+        specs.append(('learner', 'learner/{}'.format(i), args.learner_rate))
+    for i in range(args.agents):
+        specs.append(('agent', 'agent/{}'.format(i), args.agent_rate))
+    for i in range(args.evals):
+        mode = EVAL_MODES[i % len(EVAL_MODES)]
+        specs.append(('eval', 'eval/{}{}'.format(mode, i), args.eval_rate))
+    return specs
+
+
+def records_per_event(role, args):
+    "average number of Tensorplex records per step or episode"
+    if role == 'learner':
+        n = args.learner_tags
+        if args.histogram_every:
+            n += 1. / args.histogram_every
+        if args.image_every:
+            n += 1. / args.image_every
+        return n
+    elif role == 'agent':
+        return args.agent_tags
+    else:
+        return args.eval_tags
+
+
+def target_rates(args, ramp_factor=1.):
+    "{role: records per second}"
+    rates = Counter()
+    for role, _, rate in _client_specs(args):
+        rates[role] += rate * ramp_factor * records_per_event(role, args)
+    return dict(rates)
+
+
+class _SimClient(object):
+    def __init__(self, role, client_id, rate, args):
+        self.role = role
+        self.rate = rate
+        self.tplex = TensorplexClient(
+            client_id,
+            host=args.host,
+            port=args.port,
+            ingest_processes=args.ingest_processes,
+        )
+        if args.log_port is None:
+            self.logger = None
+        else:
+            # one log file per client, no subfolders
+            self.logger = LoggerplexClient(
+                client_id.replace('/', '-'),
+                host=args.log_host or args.host,
+                port=args.log_port,
+            )
+        self._args = args
+        if role == 'learner':
+            self._tags = ['learner/metric{}'.format(i)
+                          for i in range(args.learner_tags)]
+        elif role == 'agent':
+            self._tags = ['metric{}'.format(i) for i in range(args.agent_tags)]
+        else:
+            self._tags = ['metric{}'.format(i) for i in range(args.eval_tags)]
+        self._histogram = np.random.randn(args.histogram_size)
+        self._image = np.random.randint(
+            0, 256, (3, args.image_size, args.image_size), dtype=np.uint8
+        )
+        self.step = 0
+
+    def event(self):
+        """
+        One learner step or one episode
+
+        Returns:
+            number of Tensorplex records
+        """
+        args = self._args
+        step = self.step
+        self.step += 1
+        for tag in self._tags:
+            self.tplex.add_scalar(tag, random.random(), step)
+        num_records = len(self._tags)
+        if self.role == 'learner':
+            if args.histogram_every and step % args.histogram_every == 0:
+                self.tplex.add_histogram('learner/weights', self._histogram,
+                                         step)
+                num_records += 1
+            if args.image_every and step % args.image_every == 0:
+                self.tplex.add_image('learner/frame', self._image, step)
+                num_records += 1
+        if self.logger is not None:
+            self.logger.info('step', step, 'value', random.random())
+        return num_records
+
+
+def _ramp_factor(args, elapsed):
+    if not args.ramp:
+        return 1.
+    return min(max(elapsed / args.duration, 0.), 1.)
+
+
+def _socket_stats(zmqueues):
+    return (
+        sum(q.num_sent for q in zmqueues),
+        sum(q.backlog() for q in zmqueues),
+        sum(q.send_seconds for q in zmqueues),
+    )
+
+
+def _run_process(proc_id, specs, args, barrier, reports):
+    """
+    Runs the clients of one process on a shared schedule, and puts on
+    `reports` one dict per interval
+    """
+    clients = [_SimClient(role, client_id, rate, args)
+               for role, client_id, rate in specs]
+    tplex_queues = list({id(c.tplex.zmqueue): c.tplex.zmqueue
+                         for c in clients}.values())
+    log_queues = list({id(c.logger.zmqueue): c.logger.zmqueue
+                       for c in clients if c.logger is not None}.values())
+    barrier.wait()
+    start = time.time()
+    end = start + args.duration
+    # (next event time, client index), spread the first events over a period
+    schedule = [(start + random.random() / c.rate, i)
+                for i, c in enumerate(clients) if c.rate > 0]
+    heapq.heapify(schedule)
+    interval = 0
+    interval_start = start
+    next_report = start + args.interval
+    enqueued = Counter()
+    log_lines = 0
+    max_lag = 0.
+    last = _socket_stats(tplex_queues)
+    last_log = _socket_stats(log_queues)
+    while True:
+        now = time.time()
+        if now >= next_report or now >= end:
+            stats = _socket_stats(tplex_queues)
+            log_stats = _socket_stats(log_queues)
+            reports.put({
+                'proc': proc_id,
+                'interval': interval,
+                'seconds': now - interval_start,
+                'enqueued': dict(enqueued),
+                'sent': stats[0] - last[0],
+                'backlog': stats[1],
+                'blocked_sec': stats[2] - last[2],
+                'log_lines': log_lines,
+                'log_sent': log_stats[0] - last_log[0],
+                'log_backlog': log_stats[1],
+                'log_blocked_sec': log_stats[2] - last_log[2],
+                'max_lag': max_lag,
+            })
+            last, last_log = stats, log_stats
+            enqueued = Counter()
+            log_lines = 0
+            max_lag = 0.
+            interval += 1
+            interval_start = now
+            next_report += args.interval
+            if now >= end:
+                break
+        if not schedule:
+            time.sleep(min(next_report, end) - now)
+            continue
+        t, i = schedule[0]
+        if t > now:
+            time.sleep(min(t, next_report, end) - now)
+            continue
+        client = clients[i]
+        heapq.heapreplace(schedule, (t + 1. / client.rate, i))
+        # ramp: events are scheduled at the full rate and thinned out
+        if random.random() >= _ramp_factor(args, t - start):
+            continue
+        enqueued[client.role] += client.event()
+        if client.logger is not None:
+            log_lines += 1
+        # behind schedule: this process can't generate the load, not the
+        # server's fault, run more processes
+        max_lag = max(max_lag, now - t)
+    reports.put(None)  # done
+    reports.close()
+    reports.join_thread()
+    os._exit(0)  # the client batch threads never return
+
+
+def _scrape(metrics_url):
+    """
+    Returns:
+        {metric name: sum over all the label sets}, None if unreachable
+    """
+    try:
+        text = urllib.request.urlopen(metrics_url, timeout=2).read().decode()
+    except OSError:
+        return None
+    metrics = Counter()
+    for line in text.splitlines():
+        if line and not line.startswith('#'):
+            name, value = line.rsplit(' ', 1)
+            metrics[name.split('{')[0]] += float(value)
+    return metrics
+
+
+def _summarize_interval(idx, reports, args, metrics, last_metrics):
+    """
+    Args:
+        metrics: scraped at the end of the interval, None if no --metrics-url
+        last_metrics: scraped at the end of the previous interval, or before
+            the run for the first one, None if unavailable
+    """
+    seconds = max(np.mean([r['seconds'] for r in reports]), 1e-3)
+    elapsed = (idx + 0.5) * args.interval
+    target = target_rates(args, _ramp_factor(args, elapsed))
+    enqueued = Counter()
+    for report in reports:
+        enqueued.update(report['enqueued'])
+    total_target = sum(target.values())
+    sent = sum(r['sent'] for r in reports)
+    backlog = sum(r['backlog'] for r in reports)
+    blocked = sum(r['blocked_sec'] for r in reports) / seconds / len(reports)
+    summary = {
+        'time': (idx + 1) * args.interval,
+        'target_records_per_sec': total_target,
+        'enqueued_records_per_sec': sum(enqueued.values()) / seconds,
+        'sent_records_per_sec': sent / seconds,
+        'per_role': {
+            role: {
+                'target': target[role],
+                'enqueued': enqueued[role] / seconds,
+            } for role in target
+        },
+        'backlog': backlog,
+        'blocked_fraction': blocked,
+        'max_lag': max(r['max_lag'] for r in reports),
+    }
+    if args.log_port is not None:
+        summary['log_lines_per_sec'] = \
+            sum(r['log_lines'] for r in reports) / seconds
+        summary['log_sent_per_sec'] = \
+            sum(r['log_sent'] for r in reports) / seconds
+        summary['log_backlog'] = sum(r['log_backlog'] for r in reports)
+        summary['log_blocked_fraction'] = \
+            sum(r['log_blocked_sec'] for r in reports) / seconds / len(reports)
+    dropped = None
+    if metrics is not None:
+        if last_metrics is not None:
+            # the counter is cumulative since the server started
+            dropped = (metrics['tensorplex_dropped_records_total']
+                       - last_metrics['tensorplex_dropped_records_total'])
+        summary['server'] = {
+            'dropped_records': dropped,
+            'ingest_queue_depth': metrics['tensorplex_ingest_queue_depth'],
+            'writer_queue_depth': metrics['tensorplex_writer_queue_depth'],
+        }
+    reasons = []
+    if blocked > _BLOCKED_FRACTION:
+        reasons.append('client sockets blocked {:.0%} of the time'
+                       .format(blocked))
+    if backlog > _BACKLOG_SECONDS * max(total_target, 1.):
+        reasons.append('{} records waiting in the client buffers'
+                       .format(backlog))
+    if dropped:
+        reasons.append('server dropped {:.0f} records'.format(dropped))
+    summary['backpressure'] = reasons
+    return summary
+
+
+def _print_interval(summary):
+    line = ('{:6.0f}s target {:9.0f}/s enqueued {:9.0f}/s sent {:9.0f}/s '
+            'backlog {:7d} blocked {:4.0%}'.format(
+                summary['time'], summary['target_records_per_sec'],
+                summary['enqueued_records_per_sec'],
+                summary['sent_records_per_sec'], summary['backlog'],
+                summary['blocked_fraction']))
+    if summary['max_lag'] > 1.:
+        line += ' | generator {:.1f}s behind, add --processes'.format(
+            summary['max_lag'])
+    if summary['backpressure']:
+        line += ' | BACKPRESSURE: ' + ', '.join(summary['backpressure'])
+    print(line, file=sys.stderr)
+
+
+def run(args):
+    specs = _client_specs(args)
+    assert specs, 'no clients'
+    num_procs = min(args.processes, len(specs))
+    ctx = mp.get_context('fork')
+    barrier = ctx.Barrier(num_procs)
+    reports = ctx.Queue()
+    procs = []
+    for proc_id in range(num_procs):
+        proc = ctx.Process(
+            target=_run_process,
+            args=(proc_id, specs[proc_id::num_procs], args, barrier, reports)
+        )
+        proc.start()
+        procs.append(proc)
+    print('{} clients on {} processes, target {:.0f} records/s'.format(
+        len(specs), num_procs, sum(target_rates(args).values())),
+        file=sys.stderr)
+    pending = {}  # interval: reports received so far
+    intervals = []
+    last_metrics = None
+    if args.metrics_url is not None:
+        last_metrics = _scrape(args.metrics_url)  # baseline
+    running = num_procs
+    while running:
+        report = reports.get()
+        if report is None:
+            running -= 1
+            continue
+        idx = report['interval']
+        pending.setdefault(idx, []).append(report)
+        if len(pending[idx]) == num_procs:
+            metrics = None
+            if args.metrics_url is not None:
+                metrics = _scrape(args.metrics_url)
+            summary = _summarize_interval(idx, pending.pop(idx), args,
+                                          metrics, last_metrics)
+            last_metrics = metrics
+            _print_interval(summary)
+            intervals.append(summary)
+    for proc in procs:
+        proc.join()
+
+    backpressure_at = None
+    for summary in intervals:
+        if summary['backpressure']:
+            backpressure_at = {
+                'time': summary['time'],
+                'target_records_per_sec': summary['target_records_per_sec'],
+                'sent_records_per_sec': summary['sent_records_per_sec'],
+                'reasons': summary['backpressure'],
+            }
+            break
+    steady = intervals[1:] or intervals  # skip the warmup
+    sent = [s['sent_records_per_sec'] for s in steady]
+    results = {
+        'config': vars(args),
+        'clients': len(specs),
+        'processes': num_procs,
+        'target_records_per_sec': sum(target_rates(args).values()),
+        # with --ramp, the mean would average over growing rates
+        'achieved_records_per_sec': float(max(sent) if args.ramp
+                                          else np.mean(sent)),
+        'backpressure_at': backpressure_at,
+        'intervals': intervals,
+    }
+    text = json.dumps(results, indent=2, default=str)
+    if args.out is None:
+        print(text)
+    else:
+        with open(args.out, 'w') as f:
+            f.write(text + '\n')
+    return results
+
+
+def _serve_logs(folder, port):
+    from .loggerplex import Loggerplex
+    Loggerplex(folder).start_server(port)
+
+
+def serve(args):
+    "a server with the groups of the simulated clients, for testing"
+    from .local_tensorplex import Tensorplex
+    if args.log_port is not None:
+        # own process, not a thread: the tensorplex server may fork
+        logs = mp.get_context('fork').Process(
+            target=_serve_logs,
+            args=(os.path.join(args.root, 'logs'), args.log_port),
+        )
+        logs.daemon = True
+        logs.start()
+    tplex = Tensorplex(
+        args.root,
+        max_processes=args.max_processes,
+        metrics_interval=args.metrics_interval,
+    )
+    (tplex
+     .register_normal_group('learner')
+     .register_indexed_group('agent', args.agent_bin_size)
+     .register_combined_group('eval', eval_bin_name))
+    tplex.start_server(args.port, ingest_processes=args.ingest_processes,
+                       metrics_port=args.metrics_port)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    p = commands.add_parser('run', help='replay the load against a server')
+    p.add_argument('host')
+    p.add_argument('port', type=int)
+    p.add_argument('--ingest-processes', type=int, default=1,
+                   help="must match the server's")
+    p.add_argument('--log-host', default=None,
+                   help='Loggerplex server, defaults to host')
+    p.add_argument('--log-port', type=int, default=None,
+                   help='also log a line per step to Loggerplex')
+    p.add_argument('--learners', type=int, default=1)
+    p.add_argument('--learner-rate', type=float, default=10.,
+                   help='steps per second of each learner')
+    p.add_argument('--learner-tags', type=int, default=100)
+    p.add_argument('--histogram-every', type=int, default=100,
+                   help='learner steps, 0 for no histogram')
+    p.add_argument('--histogram-size', type=int, default=10000)
+    p.add_argument('--image-every', type=int, default=1000,
+                   help='learner steps, 0 for no image')
+    p.add_argument('--image-size', type=int, default=64)
+    p.add_argument('--agents', type=int, default=64)
+    p.add_argument('--agent-rate', type=float, default=1.,
+                   help='episodes per second of each agent')
+    p.add_argument('--agent-tags', type=int, default=5)
+    p.add_argument('--evals', type=int, default=4)
+    p.add_argument('--eval-rate', type=float, default=0.2,
+                   help='episodes per second of each evaluator')
+    p.add_argument('--eval-tags', type=int, default=3)
+    p.add_argument('--processes', type=int, default=4,
+                   help='the clients are spread over this many processes')
+    p.add_argument('--duration', type=float, default=60.)
+    p.add_argument('--interval', type=float, default=5.,
+                   help='report every interval seconds')
+    p.add_argument('--ramp', action='store_true',
+                   help='grow the rates linearly up to the target')
+    p.add_argument('--metrics-url', default=None,
+                   help='e.g. http://server:9108/metrics, to report server '
+                        'drops and queue depths')
+    p.add_argument('--out', default=None, help='JSON file, else stdout')
+
+    p = commands.add_parser('serve', help='start a server for the load')
+    p.add_argument('root')
+    p.add_argument('port', type=int)
+    p.add_argument('--max-processes', type=int, default=4)
+    p.add_argument('--ingest-processes', type=int, default=1)
+    p.add_argument('--agent-bin-size', type=int, default=8)
+    p.add_argument('--log-port', type=int, default=None)
+    p.add_argument('--metrics-port', type=int, default=None)
+    p.add_argument('--metrics-interval', type=float, default=None)
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        run(args)
+    else:
+        serve(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,6 +7,9 @@ from .local_proxy import LocalProxy
 
 
 class Loggerplex(object):
+    # not forwarded by clients and proxies
+    _EXCLUDE_METHODS = ['stats']
+
     def __init__(self, folder,
                  overwrite=False,
                  level='info',
@@ -23,6 +26,7 @@ class Loggerplex(object):
         self._format = format
         self._time_format = time_format
         self._show_level = show_level
+        self._ingest_server = None  # ZmqQueueServer, set by start_server()
 
     def _get_client_logger(self, client_id):
         client_id = str(client_id)
@@ -47,7 +51,27 @@ class Loggerplex(object):
         """
         Must be called AFTER registering all the groups!
         """
-        return LocalProxy(self, client_id, exclude=[])
+        return LocalProxy(self, client_id, exclude=self._EXCLUDE_METHODS)
+
+    def stats(self):
+        """
+        Snapshot of the server counters, in the process that runs
+        start_server(), e.g. for benchmarks.
+
+        Returns:
+            {'ingest': None until start_server() listens, else a dict
+                'messages', 'records', 'bytes': received so far
+                'queue_depth': records waiting to be logged}
+        """
+        server = self._ingest_server
+        if server is None:
+            return {'ingest': None}
+        return {'ingest': {
+            'messages': server.num_messages,
+            'records': server.num_records,
+            'bytes': server.num_bytes,
+            'queue_depth': server.qsize(),
+        }}
 
 
 def _wrap_method(fname, old_method):
@@ -1,13 +1,30 @@
 import multiprocessing as mp
 import os
 import queue
+import inspect
+import re
 import threading
-from collections import namedtuple
+import time
+import zlib
+from collections import namedtuple, deque
+from functools import partial
 
+import numpy as np
 from tensorboardX import SummaryWriter
+from tensorboardX import summary as tbx_summary
+from tensorboardX.proto.summary_pb2 import Summary
 from .local_proxy import LocalProxy
+from .export import (check_export_format, export_file_name, export_scalars,
+                     export_json, event_files)
+from .aggregate import StepAggregator, AGGREGATE_STATS
+from .sampling import Sampler, SamplingRule
+from .tracing import TraceStats, LATENCY_NAMES, LATENCY_HELP, PERCENTILES
+from .profiling import ThreadProfiler
+from .drop_queue import (DropQueue, DropCounter, Barrier,
+                         check_overflow_policy, get_overflow_policy,
+                         record_lane, FAST_LANE, NUM_LANES, LANE_NAMES)
 
-from .utils import mkdir, delegate_methods
+from .utils import mkdir, delegate_methods, ErrorCounter
 
 
 _DELEGATED_METHODS = [
@@ -15,43 +32,266 @@ _DELEGATED_METHODS = [
     'add_audio',
     'add_embedding',
     'add_histogram',
+    'add_histogram_raw',
     'add_image',
     'add_text'
 ]
 
+# heavy methods that can be encoded on a separate _EncoderPool
+_ENCODED_METHODS = [
+    'add_image',
+    'add_audio',
+]
+
+# characters that tensorboardX's summary ops replace in tags, for the
+# summaries encoded by _EncoderPool, see _Writer._add_encoded_summary()
+_INVALID_TAG_CHARACTERS = re.compile(r'[^-/\w\.]')
+
+# reserved writer for the server's own curves, e.g. drop counts. Its records
+# are never dropped by the overflow policies.
+_SYSTEM_WRITER = 'tensorplex'
+
+
+def check_scalar_array(values, steps, walltimes=None):
+    """
+    Arguments of add_scalar_array(), also checked on the client so that a bad
+    call fails where it is made.
+
+    Returns:
+        (values, steps, walltimes) as 1D float64, int64 and float64 arrays,
+        walltimes may be None
+    """
+    values = np.asarray(values, dtype=np.float64)
+    steps = np.asarray(steps, dtype=np.int64)
+    assert values.ndim == 1 and steps.ndim == 1, \
+        'values and steps must be 1D'
+    assert len(values) == len(steps), \
+        'values and steps must have the same length'
+    if walltimes is not None:
+        walltimes = np.asarray(walltimes, dtype=np.float64)
+        assert walltimes.shape == values.shape, \
+            'walltimes must be 1D, with the same length as values'
+    return values, steps, walltimes
+
+
+def _encode_summary(method_name, args, kwargs):
+    """
+    Runs on an _EncoderPool process.
+
+    Returns:
+        args for _Writer._add_encoded_summary:
+        (tag, serialized Summary, global_step, walltime)
+    """
+    sig = inspect.signature(getattr(SummaryWriter, method_name))
+    bound = sig.bind(None, *args, **kwargs)
+    bound.apply_defaults()
+    a = bound.arguments
+    if method_name == 'add_image':
+        summary = tbx_summary.image(a['tag'], a['img_tensor'],
+                                    dataformats=a['dataformats'])
+    elif method_name == 'add_audio':
+        summary = tbx_summary.audio(a['tag'], a['snd_tensor'],
+                                    sample_rate=a['sample_rate'])
+    else:
+        raise ValueError('cannot encode method ' + method_name)
+    return (a['tag'], summary.SerializeToString(),
+            a['global_step'], a['walltime'])
+
 
 class _Writer(object):
-    def __init__(self, root_folder, sub_folder):
+    # rotation is checked at most once per interval, not on every event
+    _ROTATE_CHECK_INTERVAL = 1.
+    _TAG_CACHE_SIZE = 4096
+
+    def __init__(self, root_folder, sub_folder,
+                 rotate_bytes=None, rotate_secs=None,
+                 flush_secs=None, max_queue=None):
+        """
+        Args:
+            rotate_bytes: start a new event file when the current one exceeds
+                this size on disk. Checked against the flushed size, so a file
+                can overshoot by what tensorboardX has buffered.
+            rotate_secs: start a new event file after this many seconds
+            flush_secs: SummaryWriter flush interval, None for default
+            max_queue: SummaryWriter pending event queue size,
+                None for default
+        """
         # print('Launch new process', root_folder, sub_folder)
         self.folder = os.path.expanduser(os.path.join(root_folder, sub_folder))
         mkdir(self.folder)
         assert os.path.exists(self.folder), 'cannot create folder '+self.folder
-        self.writer = SummaryWriter(self.folder)
+        self._file_index = 0
+        self._warned_event_file = False
+        self._summary_kwargs = {}
+        if flush_secs is not None:
+            self._summary_kwargs['flush_secs'] = flush_secs
+        if max_queue is not None:
+            self._summary_kwargs['max_queue'] = max_queue
+        self._open_writer()
+        self._rotate_bytes = rotate_bytes
+        self._rotate_secs = rotate_secs
+        self._file_start_time = time.time()
+        self._next_rotate_check = 0.
+        self._tag_cache = {}  # (tag, client_tag): rewritten tag
 
-    def _delegate(self, tag, *args, _client_tag_, _method_name_, **kwargs):
-        "delegate to tensorboard-pytorch methods"
+    def _reopen(self):
+        """
+        Close the current event file and continue in a new one in the same
+        folder. TensorBoard stitches all event files in a folder together.
+        """
+        self.writer.close()
+        self._file_index += 1
+        self._open_writer()
+        self._file_start_time = time.time()
+
+    def _open_writer(self):
+        """
+        SummaryWriter creates its event file right away, but doesn't expose
+        the file name: it is the one that wasn't in the folder before.
+        """
+        kwargs = dict(self._summary_kwargs)
+        if self._file_index:
+            # unique suffix: tfevents file names only have 1-second resolution
+            kwargs['filename_suffix'] = '.{:04d}'.format(self._file_index)
+        old_files = set(event_files(self.folder))
+        self.writer = SummaryWriter(self.folder, **kwargs)
+        new_files = set(event_files(self.folder)) - old_files
+        self._event_file = max(new_files) if new_files else None
+
+    def _event_file_size(self):
+        event_file = self._event_file
+        if event_file is None:
+            # e.g. a file name collision: the newest file in the folder,
+            # names start with the creation time
+            files = event_files(self.folder)
+            if not files:
+                return 0
+            event_file = files[-1]
+            if not self._warned_event_file:
+                self._warned_event_file = True
+                print('Tensorplex writer {} cannot tell its current event '
+                      'file, rotate_bytes checks {}'
+                      .format(self.folder, event_file))
+        try:
+            return os.path.getsize(event_file)
+        except OSError:
+            return 0
+
+    def _maybe_rotate(self):
+        """
+        Completed event files are never touched again, so they are cheap to
+        sync incrementally.
+        """
+        if self._rotate_bytes is None and self._rotate_secs is None:
+            return
+        now = time.time()
+        if now < self._next_rotate_check:
+            return
+        self._next_rotate_check = now + self._ROTATE_CHECK_INTERVAL
+        if ((self._rotate_secs is not None
+                and now - self._file_start_time >= self._rotate_secs)
+            or (self._rotate_bytes is not None
+                and self._event_file_size() >= self._rotate_bytes)):
+            self._reopen()
+
+    def _rewrite_tag(self, tag, client_tag):
+        """
+        Memoized, the number of distinct (tag, client_tag) pairs per writer is
+        tiny compared with the number of events.
+        """
+        key = (tag, client_tag)
+        try:
+            return self._tag_cache[key]
+        except KeyError:
+            pass
+        new_tag = self._compute_tag(tag, client_tag)
+        if len(self._tag_cache) >= self._TAG_CACHE_SIZE:
+            self._tag_cache.clear()  # bounded, e.g. if tags embed a step
+        self._tag_cache[key] = new_tag
+        return new_tag
+
+    @staticmethod
+    def _compute_tag(tag, client_tag):
         tag = tag.replace(':', '.').replace('#', '.')
-        if isinstance(_client_tag_, tuple):  # indexed group
-            group, bin_name = _client_tag_
+        if isinstance(client_tag, tuple):  # indexed group
+            group, bin_name = client_tag
             if tag.startswith('.') or tag.startswith('/'):
                 tag = group + tag + '/' + bin_name
             else:
                 tag = group + '/' + tag + '/' + bin_name
         else:  # normal group
-            group = _client_tag_
+            group = client_tag
             if tag.startswith('.') or tag.startswith('/'):
                 tag = group + tag
             else:
                 tag = group + '/' + tag
+        return tag
+
+    def _delegate(self, tag, *args, _client_tag_, _method_name_, **kwargs):
+        "delegate to tensorboard-pytorch methods"
+        tag = self._rewrite_tag(tag, _client_tag_)
         getattr(self.writer, _method_name_)(tag, *args, **kwargs)
 
+    def _file_writer(self):
+        "the tensorboardX FileWriter of the current event file"
+        file_writer = getattr(self.writer, 'file_writer', None)
+        if file_writer is None:  # closed, or older tensorboardX
+            file_writer = self.writer._get_file_writer()
+        return file_writer
+
+    def _add_encoded_summary(self, tag, summary_str, global_step, walltime,
+                             *, _client_tag_):
+        "image/audio already encoded by _EncoderPool, only fix the tag"
+        summary = Summary.FromString(summary_str)
+        tag = self._rewrite_tag(tag, _client_tag_)
+        # same as tensorboardX's summary ops
+        tag = _INVALID_TAG_CHARACTERS.sub('_', tag).lstrip('/')
+        for value in summary.value:
+            value.tag = tag
+        self._file_writer().add_summary(summary, global_step, walltime)
+
+    def _add_scalar_array(self, tag, values, steps, walltimes,
+                          *, _client_tag_):
+        """
+        bulk add_scalar, bypasses SummaryWriter.add_scalar's per-call checks
+        """
+        tag = self._rewrite_tag(tag, _client_tag_)
+        file_writer = self._file_writer()
+        if walltimes is None:
+            walltimes = [time.time()] * len(values)
+        else:
+            walltimes = walltimes.tolist()
+        for value, step, walltime in zip(values.tolist(),
+                                         steps.tolist(),
+                                         walltimes):
+            file_writer.add_summary(
+                Summary(value=[Summary.Value(tag=tag, simple_value=value)]),
+                step,
+                walltime
+            )
+
     def _export_json(self, json_path):
-        self.writer.export_scalars_to_json(json_path)
+        # read back from the event files like _export(), tensorboardX 2.x
+        # only keeps add_scalars() in its scalar_dict
+        self._reopen()
+        export_json(self.folder, json_path)
+
+    def _export(self, path, writerID, format, chunk_size):
+        # exporter reads back the event files, close() is the only way to
+        # make sure tensorboardX's async event queue is fully on disk
+        self._reopen()
+        export_scalars(self.folder, path, writerID, format, chunk_size)
 
     def process(self, method_name, client_tag, args, kwargs):
         # print('queue:', method_name, args, kwargs, '--', self.folder[-10:])
         if method_name == 'export_json':
             self._export_json(*args, **kwargs)
+        elif method_name == 'export':
+            self._export(*args, **kwargs)
+        elif method_name == 'add_scalar_array':
+            self._add_scalar_array(*args, _client_tag_=client_tag, **kwargs)
+        elif method_name == 'add_encoded_summary':
+            self._add_encoded_summary(*args, _client_tag_=client_tag, **kwargs)
         else:
             self._delegate(
                 *args,
@@ -59,11 +299,18 @@ class _Writer(object):
                 _client_tag_=client_tag,
                 **kwargs
             )
+        self._maybe_rotate()
 
 
 # notify WriterGroup on a separate process to create a new writer
+# writer_options: kwargs dict for _Writer
 _AddWriterRequest = namedtuple('_AddWriterRequest',
-                               'writerID root_folder sub_folder')
+                               'writerID root_folder sub_folder writer_options')
+
+# export all the writers of a WriterGroup to <export_dir>/<writerID>.<format>
+# format 'json' for export_json()
+_ExportRequest = namedtuple('_ExportRequest',
+                            'export_dir format chunk_size')
 
 # dummy value to ask WriterGroup to print something
 # debugging: useful to check when the queue on the WriterGroup process is "done"
@@ -74,102 +321,715 @@ class _WriterGroup(object):
     """
     Each WriterGroup lives on a separate process
     """
-    def __init__(self, proc_id, queue, parallel_cls):
+    # process mode: max records pulled from each lane's mp.Queue ahead of
+    # processing. Small, so that bounded mp.Queues still apply backpressure.
+    _LOCAL_LANE_SIZE = 16
+    # max seconds before an idle group notices a profiling request
+    _PROFILE_POLL_INTERVAL = 1.
+
+    def __init__(self, proc_id, queue, parallel_cls, started=None,
+                 trace_queue=None, profiling=None, profile_dir=None):
+        """
+        Args:
+            queue: DropQueue with lanes in thread mode,
+                list of one mp.Queue per lane in process mode
+            started: number of items taken from each lane, a shared array
+                in process mode, updated by the lane queue. Lets the
+                supervisor in _ProcessPool replay what was still queued if
+                the process dies, and measure the processing rate.
+            trace_queue: completed traces are put on it, see tracing.py
+            profiling: shared counter, the group profiles itself while it's
+                odd, see _ProcessPool.set_profiling()
+            profile_dir: where the profiles are dumped
+        """
         self._pool = {}  # writerID: _Writer instance
         self._proc_id = proc_id  # process ID, for debugging
         self._queue = queue
+        self._started = started
+        self._trace_queue = trace_queue
+        self._profiling = profiling
+        self._profiling_seen = 0
+        self._profiler = ThreadProfiler(profile_dir)
         self.ProcessCls = parallel_cls
 
-    def _add_writer(self, writerID, root_folder, sub_folder):
+    def _add_writer(self, writerID, root_folder, sub_folder, writer_options):
         # print('newwriter', self._proc_id, writerID, root_folder, sub_folder)
-        self._pool[writerID] = _Writer(root_folder, sub_folder)
+        if writerID in self._pool:
+            return  # already requested by another ingest process
+        self._pool[writerID] = _Writer(root_folder, sub_folder,
+                                       **writer_options)
+
+    def _export(self, export_dir, format, chunk_size):
+        for writerID, writer in self._pool.items():
+            path = os.path.join(export_dir, export_file_name(writerID, format))
+            if format == 'json':
+                writer.process('export_json', None, (path,), {})
+            else:
+                writer.process('export', None,
+                               (path, writerID, format, chunk_size), {})
 
-    def _process(self, writerID, writer_args):
+    def _process(self, writerID, writer_args, trace=None):
         assert writerID in self._pool
         writer = self._pool[writerID]
+        if trace is None:
+            writer.process(*writer_args)
+            return
+        trace.append(time.time())
         writer.process(*writer_args)
+        trace.append(time.time())
+        self._trace_queue.put(trace)
+
+    @staticmethod
+    def _feed_lane(lane_queue, local_queue, lane):
+        while True:
+            local_queue.put(lane_queue.get(), lane=lane)
+
+    def _merge_lanes(self):
+        """
+        Process mode: one feeder thread per lane moves records from the
+        mp.Queues to a local DropQueue that schedules the lanes
+        """
+        local_queue = DropQueue(
+            self._LOCAL_LANE_SIZE,
+            kind_fn=_writer_queue_item_kind,
+            lane_fn=_writer_queue_item_lane,
+            taken=self._started,
+        )
+        for lane, lane_queue in enumerate(self._queue):
+            feeder = threading.Thread(
+                target=self._feed_lane,
+                args=(lane_queue, local_queue, lane),
+            )
+            feeder.daemon = True
+            feeder.start()
+        self._queue = local_queue
+
+    def _check_profiling(self):
+        state = self._profiling[0]
+        if state == self._profiling_seen:
+            return
+        self._profiling_seen = state
+        try:
+            if state % 2:
+                if not self._profiler.start():
+                    print('Tensorplex writer group {} cannot profile, another '
+                          'profiler is active in the process'
+                          .format(self._proc_id))
+            else:
+                path = self._profiler.stop('writer{}'.format(self._proc_id))
+                if path is not None:
+                    print('Tensorplex writer group {} profile saved to {}'
+                          .format(self._proc_id, path))
+        except Exception as e:  # e.g. cannot write the profile
+            print('Tensorplex writer group {} failed to profile: {!r}'
+                  .format(self._proc_id, e))
 
     def _dequeue_loop(self):
+        if isinstance(self._queue, list):
+            self._merge_lanes()
         while True:
-            msg = self._queue.get()
-            if isinstance(msg, _AddWriterRequest):
-                self._add_writer(*msg)
-            elif isinstance(msg, _PrintRequest):
-                print(*msg)  # debugging, check done
-            else:  # normal writer workload request
-                self._process(*msg)
+            try:
+                msg = self._queue.get(timeout=self._PROFILE_POLL_INTERVAL)
+            except queue.Empty:
+                self._check_profiling()
+                continue
+            # msg is already counted in `started`: if it crashes the
+            # process, it won't be replayed
+            self._check_profiling()
+            try:
+                if isinstance(msg, _AddWriterRequest):
+                    self._add_writer(*msg)
+                elif isinstance(msg, _ExportRequest):
+                    self._export(*msg)
+                elif isinstance(msg, _PrintRequest):
+                    print(*msg)  # debugging, check done
+                else:  # normal writer workload request
+                    self._process(*msg)
+            except Exception as e:
+                # one bad record must not take down every writer of the group
+                print('Tensorplex writer group {} failed to process {}: {!r}'
+                      .format(self._proc_id, _writer_queue_item_kind(msg)
+                              or type(msg).__name__, e))
 
     def run(self):
         "after run(), everything should be communicated through queue"
         proc = self.ProcessCls(target=self._dequeue_loop)
         proc.daemon = True
         proc.start()
+        return proc
+
+
+class _EncoderPool(object):
+    """
+    Image and audio encoding (e.g. PNG) runs on a dedicated pool of processes,
+    so that one client logging video frames doesn't stall all the other
+    writers that share its _WriterGroup.
+
+    Per-writer ordering is preserved within the heavy lane: while a writer
+    has an encoding job in flight, its subsequent heavy records are held back
+    and released in order as soon as the job completes. Its fast records
+    (scalars, text) and other writers are not affected.
+
+    The records held by the pool, encoding or held back, are bounded like a
+    writer queue lane, see `max_pending`.
+    """
+    def __init__(self, num_processes, put_fn, mp_context=mp, errors=None,
+                 max_pending=0, overflow_policy='block', on_drop=None):
+        """
+        Args:
+            num_processes: size of the encoding pool
+            put_fn: (writerID, writer_args) -> None, puts the record on the
+                queue of the _WriterGroup that owns the writer
+            mp_context: multiprocessing context, for the start method
+            errors: ErrorCounter for the records that fail to encode,
+                counted per writerID
+            max_pending: max records held by the pool, 0 for unbounded
+            overflow_policy: see DropQueue. In-flight records cannot be
+                evicted, so every non-blocking policy drops the newest record.
+            on_drop: callback(writerID, writer_args) for every dropped record
+        """
+        self._pool = mp_context.Pool(num_processes)
+        self._put = put_fn
+        if errors is None:
+            errors = ErrorCounter('Tensorplex encoder')
+        self._errors = errors
+        self._max_pending = max_pending
+        self._overflow_policy = overflow_policy
+        self._on_drop = on_drop
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        # writerID: deque of [is_ready, writer_args] in submission order
+        self._pending = {}
+        self._num_pending = 0
+
+    def join(self, timeout=None):
+        "wait until all the in-flight records are on the writer queues"
+        with self._idle:
+            self._idle.wait_for(lambda: not self._pending, timeout)
+
+    def terminate(self):
+        self._pool.terminate()
+
+    def submit(self, writerID, writer_args):
+        """
+        Returns:
+            False if the record isn't handled by the encoder pool and should be
+            put on the writer queue directly by the caller
+        """
+        method_name, client_tag, args, kwargs = writer_args
+        with self._lock:
+            is_encoded = method_name in _ENCODED_METHODS
+            if not is_encoded and not (
+                    writerID in self._pending
+                    and record_lane(method_name) != FAST_LANE):
+                return False
+            if 0 < self._max_pending <= self._num_pending:
+                policy = get_overflow_policy(self._overflow_policy,
+                                             method_name)
+                if policy != 'block':
+                    if self._on_drop is not None:
+                        self._on_drop(writerID, writer_args)
+                    return True
+                self._not_full.wait_for(
+                    lambda: self._num_pending < self._max_pending
+                )
+                if not is_encoded and writerID not in self._pending:
+                    return False  # released meanwhile, nothing to wait for
+            self._num_pending += 1
+            if is_encoded:
+                slot = [False, None]
+                self._pending.setdefault(writerID, deque()).append(slot)
+                self._pool.apply_async(
+                    _encode_summary,
+                    (method_name, args, kwargs),
+                    callback=partial(self._on_encoded,
+                                     writerID, slot, client_tag),
+                    error_callback=partial(self._on_error, writerID, slot),
+                )
+            else:
+                self._pending[writerID].append([True, writer_args])
+            return True
+
+    def _on_encoded(self, writerID, slot, client_tag, encoded_args):
+        "called from the mp.Pool result thread"
+        with self._lock:
+            slot[0] = True
+            slot[1] = ('add_encoded_summary', client_tag, encoded_args, {})
+            self._release(writerID)
+
+    def _on_error(self, writerID, slot, exc):
+        "called from the mp.Pool result thread"
+        self._errors.count(writerID, exc)
+        with self._lock:
+            slot[0] = True  # drop the record, slot[1] stays None
+            self._release(writerID)
+
+    def _release(self, writerID):
+        "flush all the ready records at the head of the pending queue"
+        pending = self._pending[writerID]
+        while pending and pending[0][0]:
+            _, writer_args = pending.popleft()
+            self._num_pending -= 1
+            self._not_full.notify()
+            if writer_args is not None:
+                self._put(writerID, writer_args)
+        if not pending:
+            del self._pending[writerID]
+            if not self._pending:
+                self._idle.notify_all()
+
+
+def _writer_queue_item_kind(item):
+    "DropQueue kind of an item on a _WriterGroup queue"
+    if isinstance(item, (_AddWriterRequest, _ExportRequest, _PrintRequest)):
+        return None  # control message, never dropped
+    if item[0] == _SYSTEM_WRITER:
+        return None  # e.g. drop counts, must not be dropped in turn
+    # (writerID, writer_args) or (writerID, writer_args, trace)
+    return item[1][0]  # method name
+
+
+def _writer_queue_item_lane(item):
+    if isinstance(item, (_AddWriterRequest, _ExportRequest, _PrintRequest)):
+        return None  # barrier
+    return record_lane(item[1][0])
 
 
 class _ProcessPool(object):
-    def __init__(self, root_folder, max_processes):
+    # process mode: dead _WriterGroup processes are detected at most once per
+    # interval, on submit()
+    _HEALTH_CHECK_INTERVAL = 1.
+    # max records per lane kept for replay after a crash with unbounded
+    # writer queues, bounds the memory if a writer process falls far behind
+    _REPLAY_SIZE = 100000
+    # a blocking put on a writer queue releases the queue lock this often
+    _PUT_TIMEOUT = 0.1
+
+    def __init__(self, root_folder, max_processes, max_threads=1,
+                 encoder_processes=0, start_method=None, prewarm=False,
+                 writer_options_fn=None,
+                 queue_size=0, overflow_policy='block', on_drop=None,
+                 errors=None):
+        """
+        Args:
+            writer_options_fn: writerID -> kwargs dict for _Writer,
+                called once per new writer
+            queue_size: max records queued per lane of each _WriterGroup,
+                0 for unbounded
+            overflow_policy: see DropQueue. In process mode, the mp.Queue
+                cannot evict queued records, so every non-blocking policy
+                drops the newest record.
+            on_drop: callback(writerID, writer_args) for every dropped record
+            errors: ErrorCounter for the records that fail to encode on the
+                _EncoderPool
+        """
         self._root_folder = root_folder
+        self._queue_size = queue_size
+        self._overflow_policy = overflow_policy
+        if on_drop is None:
+            on_drop = lambda writerID, writer_args: None
+        self._on_drop = on_drop
+        self._errors = errors  # None: _EncoderPool makes its own
+        if writer_options_fn is None:
+            writer_options_fn = lambda writerID: {}
+        self._writer_options_fn = writer_options_fn
         self._occupancy = []  # writer count per process, for load balancing
         self._proc_queues = []
+        self._procs = []
         if max_processes == 0:
+            assert max_threads > 0
             self._is_thread = True
-            max_processes = 1
+            self._max_procs = max_threads
         else:
             self._is_thread = False
-        self._max_procs = max_processes
-        self._writer_id_queue = {}
+            self._max_procs = max_processes
+        self._ctx = mp.get_context(start_method)
+        if start_method == 'forkserver':
+            # the fork server imports tensorboardX once, every _WriterGroup
+            # forked from it starts with the imports already done
+            self._ctx.set_forkserver_preload([__name__])
+        self._writer_id_proc = {}  # writerID: index of its _WriterGroup
+        self._hash_routing = False
+        # supervisor, process mode only, see _check_processes()
+        self._supervised = not self._is_thread
+        self._started = []  # per process: shared array, see _WriterGroup
+        self._replay = []  # per process and lane: deque of queued items
+        self._replay_base = []  # per process and lane: seq of _replay[0]
+        if queue_size > 0:
+            # at most that many records per lane are not taken yet: queued,
+            # pulled ahead by the _WriterGroup, or held by its feeder thread
+            self._replay_size = (queue_size + _WriterGroup._LOCAL_LANE_SIZE
+                                 + 1)
+        else:
+            self._replay_size = self._REPLAY_SIZE
+        # the supervisor replaces the queues of a dead process while the
+        # encoder pool thread may be putting records on them
+        self._queues_lock = threading.RLock()
+        self._next_health_check = 0.
+        self.num_restarts = 0
+        if self._is_thread:
+            self.trace_queue = queue.SimpleQueue()
+        else:
+            self.trace_queue = self._ctx.Queue()
+        # incremented to start and stop profiling the _WriterGroups
+        if self._is_thread:
+            self._profiling = [0]
+        else:
+            self._profiling = self._ctx.RawArray('i', 1)
+        self._encoder_processes = encoder_processes
+        self._encoder_pool = None
+        self._start_encoder_pool()
+        if prewarm:
+            while len(self._proc_queues) < self._max_procs:
+                self._start_process()
+
+    def _start_encoder_pool(self):
+        if self._encoder_processes > 0:
+            self._encoder_pool = _EncoderPool(
+                self._encoder_processes, put_fn=self._put,
+                mp_context=self._ctx, errors=self._errors,
+                max_pending=self._queue_size,
+                overflow_policy=self._overflow_policy,
+                on_drop=self._on_drop,
+            )
+
+    def enable_hash_routing(self):
+        """
+        Start all the _WriterGroup processes, and from now on assign each
+        writer to a fixed process by hashing its writerID. Must be called
+        before forking ingest processes: they all inherit the queues and agree
+        on where every writer lives without talking to each other.
+        Dead writer processes cannot be restarted in this mode, no single
+        ingest process owns their queues.
+        """
+        assert not self._is_thread, \
+            'multiple ingest processes require max_processes > 0'
+        assert not self._writer_id_proc, \
+            'hash routing must be enabled before the first record'
+        while len(self._proc_queues) < self._max_procs:
+            self._start_process()
+        self._hash_routing = True
+        self._supervised = False
+        if self._encoder_pool is not None:
+            # mp.Pool doesn't survive a fork, see after_fork()
+            self._encoder_pool.terminate()
+            self._encoder_pool = None
+
+    def after_fork(self):
+        "in a forked ingest process"
+        self._start_encoder_pool()
+
+    def _new_queue(self):
+        if self._is_thread:
+            # records are passed by reference, no pickling and no pipe
+            return DropQueue(
+                self._queue_size,
+                kind_fn=_writer_queue_item_kind,
+                overflow_policy=self._overflow_policy,
+                on_drop=lambda item: self._on_drop(*item[:2]),
+                lane_fn=_writer_queue_item_lane,
+            )
+        else:
+            return [self._ctx.Queue(self._queue_size)
+                    for _ in range(NUM_LANES)]
 
-    def _select_process(self):
-        "select the next vacant process, returns queue associated"
+    def _launch(self, idx, proc_queue):
+        """
+        Start the _WriterGroup number idx on proc_queue, raises if it cannot
+        be started (e.g. fork fails with ENOMEM).
+
+        Returns:
+            (process or thread, started array)
+        """
+        if self._is_thread:
+            started = proc_queue.taken
+        else:
+            started = self._ctx.Array('q', NUM_LANES, lock=False)
+        proc = _WriterGroup(
+            proc_id=idx,
+            queue=proc_queue,
+            parallel_cls=threading.Thread if self._is_thread
+                         else self._ctx.Process,
+            started=started,
+            trace_queue=self.trace_queue,
+            profiling=self._profiling,
+            profile_dir=os.path.join(os.path.expanduser(self._root_folder),
+                                     _SYSTEM_WRITER, 'profiles'),
+        ).run()
+        return proc, started
+
+    def _start_process(self):
+        "create a new proc (one _WriterGroup per proc)"
+        proc_queue = self._new_queue()
+        # nothing is registered until the process runs
+        proc, started = self._launch(len(self._procs), proc_queue)
+        self._occupancy.append(0)
+        self._replay.append([deque() for _ in range(NUM_LANES)])
+        self._replay_base.append([0] * NUM_LANES)
+        self._proc_queues.append(proc_queue)
+        self._started.append(started)
+        self._procs.append(proc)
+
+    def _select_process(self, writerID):
+        "select the next vacant process, returns its index"
         assert len(self._occupancy) == len(self._proc_queues)
-        if len(self._proc_queues) < self._max_procs:
-            # create a new proc (one _WriterGroup per proc)
-            q = mp.Queue()
-            self._occupancy.append(1)
-            self._proc_queues.append(q)
-            _WriterGroup(
-                proc_id=len(self._occupancy)-1,
-                queue=q,
-                parallel_cls=threading.Thread if self._is_thread else mp.Process
-            ).run()
-            return q
+        if self._hash_routing:
+            idx = zlib.crc32(writerID.encode()) % len(self._proc_queues)
+        elif len(self._proc_queues) < self._max_procs:
+            self._start_process()
+            idx = len(self._proc_queues) - 1
         else:
             # get the smallest occupancy, and return the queue
             idx = self._occupancy.index(min(self._occupancy))
-            self._occupancy[idx] += 1
-            return self._proc_queues[idx]
+        self._occupancy[idx] += 1
+        return idx
 
-    def submit(self, writerID, writer_args):
-        if writerID not in self._writer_id_queue:
-            queue = self._select_process()
-            self._writer_id_queue[writerID] = queue
+    def _add_writer_request(self, writerID):
+        return _AddWriterRequest(
+            writerID=writerID,
+            root_folder=self._root_folder,
+            sub_folder=writerID,  # by convention
+            writer_options=self._writer_options_fn(writerID),
+        )
+
+    def _health_check(self):
+        if self._supervised:
+            now = time.time()
+            if now >= self._next_health_check:
+                self._next_health_check = now + self._HEALTH_CHECK_INTERVAL
+                self._check_processes()
+
+    def submit(self, writerID, writer_args, trace=None):
+        """
+        Args:
+            trace: timestamps of a sampled record, see tracing.py
+        """
+        self._health_check()
+        if writerID not in self._writer_id_proc:
+            idx = self._select_process(writerID)
+            self._writer_id_proc[writerID] = idx
             # request to add a new writer to _WriterGroup process
-            queue.put(_AddWriterRequest(
-                writerID=writerID,
-                root_folder=self._root_folder,
-                sub_folder=writerID  # by convention
-            ))
-        queue = self._writer_id_queue[writerID]
+            self._put_barrier(idx, self._add_writer_request(writerID))
         # now we are ready to put the real workload
-        queue.put((writerID, writer_args))
+        if (self._encoder_pool is not None
+                and self._encoder_pool.submit(writerID, writer_args)):
+            return  # encoded records are not traced
+        self._put(writerID, writer_args, trace)
+
+    def _put_lane(self, idx, lane, item, block=True):
+        """
+        A blocking put retries every _PUT_TIMEOUT without holding the lock
+        (unless the caller holds it, see _put_barrier), and checks that the
+        process is alive: a dead process with a full queue is restarted, from
+        this thread or another one
+        """
+        while True:
+            with self._queues_lock:
+                try:
+                    self._proc_queues[idx][lane].put(
+                        item, block=block,
+                        timeout=self._PUT_TIMEOUT if block else None
+                    )
+                except queue.Full:
+                    if not block:
+                        raise
+                else:
+                    if self._supervised:
+                        replay = self._replay[idx][lane]
+                        replay.append(item)
+                        if len(replay) > self._replay_size:
+                            replay.popleft()
+                            self._replay_base[idx][lane] += 1
+                    return
+            self._health_check()
+
+    def _put_barrier(self, idx, item):
+        """
+        The item comes out after every record put before it, on all lanes.
+        In process mode, the lock is held until the copies are on every lane,
+        even if a put blocks: otherwise two threads could leave their barriers
+        in a different order on each lane, and DropQueue would have to serve
+        one of them ahead of the records before its other copy.
+        """
+        if self._is_thread:
+            self._proc_queues[idx].put(item)  # DropQueue puts it on every lane
+        else:
+            # the copies on each lane are matched by key, see DropQueue
+            barrier = Barrier(item)
+            with self._queues_lock:
+                for lane in range(NUM_LANES):
+                    self._put_lane(idx, lane, barrier)
+
+    def _put(self, writerID, writer_args, trace=None):
+        idx = self._writer_id_proc[writerID]
+        if trace is None:
+            item = (writerID, writer_args)
+        else:
+            item = (writerID, writer_args, trace)
+        if self._is_thread:
+            self._proc_queues[idx].put(item)
+            return
+        lane = record_lane(writer_args[0])
+        if lane is None:  # e.g. export, after all the records so far
+            self._put_barrier(idx, item)
+            return
+        if self._queue_size > 0 and writerID != _SYSTEM_WRITER:
+            policy = get_overflow_policy(self._overflow_policy, writer_args[0])
+            if policy != 'block':
+                try:
+                    self._put_lane(idx, lane, item, block=False)
+                except queue.Full:
+                    self._on_drop(writerID, writer_args)
+                return
+        self._put_lane(idx, lane, item)
+
+    def _check_processes(self):
+        """
+        Supervisor: forget the replay records that the _WriterGroup processes
+        have already taken, and restart the dead ones
+        """
+        with self._queues_lock:
+            for idx, proc in enumerate(self._procs):
+                started = self._started[idx]
+                for lane in range(NUM_LANES):
+                    replay = self._replay[idx][lane]
+                    base = self._replay_base[idx]
+                    for _ in range(min(started[lane] - base[lane],
+                                       len(replay))):
+                        replay.popleft()
+                    base[lane] = max(base[lane], started[lane])
+                if not proc.is_alive():
+                    try:
+                        self._restart(idx, proc.exitcode)
+                    except OSError as e:
+                        # the dead process stays in place, retried at the
+                        # next health check
+                        print('Tensorplex cannot restart writer process {}: '
+                              '{!r}'.format(idx, e))
+
+    def _restart(self, idx, exitcode):
+        """
+        Restart a dead _WriterGroup on fresh queues: the dead process may have
+        left the old ones locked or half-read. Its writers are re-created and
+        the records it had not taken yet are replayed. The record it was
+        processing when it died is not, in case it's the one that killed it.
+        Called with _queues_lock held. If the new process cannot be started,
+        raises and leaves everything as it was.
+        """
+        writer_ids = [writerID for writerID, i in self._writer_id_proc.items()
+                      if i == idx]
+        print('Tensorplex writer process {} died (exit code {}), restarting '
+              'with {} writers'.format(idx, exitcode, len(writer_ids)))
+        proc_queue = self._new_queue()
+        proc, started = self._launch(idx, proc_queue)
+        self.num_restarts += 1
+        replay = self._replay[idx]
+        self._replay[idx] = [deque() for _ in range(NUM_LANES)]
+        self._replay_base[idx] = [0] * NUM_LANES
+        for old_queue in self._proc_queues[idx]:
+            # don't wait at exit for a pipe that nobody reads anymore
+            old_queue.cancel_join_thread()
+            old_queue.close()
+        self._proc_queues[idx] = proc_queue
+        self._started[idx] = started
+        self._procs[idx] = proc
+        for writerID in writer_ids:
+            self._put_barrier(idx, self._add_writer_request(writerID))
+        for lane in range(NUM_LANES):
+            for item in replay[lane]:
+                self._put_lane(idx, lane, item)
+
+    def set_profiling(self, on):
+        """
+        Every _WriterGroup starts or stops profiling within
+        _WriterGroup._PROFILE_POLL_INTERVAL, ahead of the queued records
+        """
+        if bool(self._profiling[0] % 2) != on:
+            self._profiling[0] += 1
+
+    def completed_traces(self):
+        "traces put on trace_queue by the _WriterGroups since the last call"
+        traces = []
+        while True:
+            try:
+                traces.append(self.trace_queue.get_nowait())
+            except queue.Empty:
+                return traces
 
     def all_writer_ids(self):
-        return list(self._writer_id_queue.keys())
+        return list(self._writer_id_proc.keys())
+
+    def writer_pids(self):
+        "pid of each _WriterGroup process, None in thread mode"
+        return [getattr(proc, 'pid', None) for proc in self._procs]
+
+    def queue_stats(self):
+        """
+        Returns:
+            list of (queue depth per lane, items taken per lane) for each
+            _WriterGroup. The depth is None where mp.Queue.qsize() is not
+            implemented (macOS).
+        """
+        stats = []
+        # may run on the metrics thread while a process is being started,
+        # zip() stops at the shorter list
+        for q, started in zip(self._proc_queues, self._started):
+            if self._is_thread:
+                depths = q.lane_sizes()
+            else:
+                try:
+                    depths = [lane_queue.qsize() for lane_queue in q]
+                except NotImplementedError:
+                    depths = None
+            stats.append((depths, list(started)))
+        return stats
+
+    def broadcast(self, msg):
+        """
+        Put a control message on every _WriterGroup, after all the records
+        submitted so far
+        """
+        if self._encoder_pool is not None:
+            self._encoder_pool.join()
+        for idx in range(len(self._proc_queues)):
+            self._put_barrier(idx, msg)
 
     def print_done(self):
         "debugging"
         for writerID in self.all_writer_ids():
-            queue = self._writer_id_queue[writerID]
-            queue.put(_PrintRequest(writerID, 'done'))
+            idx = self._writer_id_proc[writerID]
+            self._put_barrier(idx, _PrintRequest(writerID, 'done'))
+
+
+def _record_tag(args, kwargs):
+    "best-effort tag of a record, for accounting"
+    tag = args[0] if args else kwargs.get('tag')
+    return tag if isinstance(tag, str) else '?'
 
 
 class Tensorplex(object):
+    # server housekeeping (aggregate expiry, drop and error counts) runs at
+    # most once per interval, in the dispatch loop
+    _PERIODIC_INTERVAL = 1.
+    _COUNTER_LOG_INTERVAL = 10.
+
+    # methods that take the `_trace_` of a sampled record, see tracing.py
+    _TRACED_METHODS = set(_DELEGATED_METHODS) | {
+        'add_scalars',
+        'add_scalar_array',
+    }
+
     _EXCLUDE_METHODS = [
         'register_normal_group',
         'register_combined_group',
         'register_indexed_group',
+        'clear_route_cache',
+        'register_sampling_rule',
         'proxy',
         'start_server',
+        'stats',
+        'pop_trace_percentiles',
     ]
     """
     https://github.com/tensorflow/tensorboard/issues/300
@@ -193,12 +1053,73 @@ class Tensorplex(object):
     For example, ':learning:rate/my/group/eps' is under
         "<client_id>.learning.rate" section.
     """
-    def __init__(self, root_folder, max_processes):
+    def __init__(self, root_folder, max_processes, max_threads=1,
+                 encoder_processes=0, prewarm=False, start_method=None,
+                 rotate_bytes=None, rotate_secs=None,
+                 ingest_queue_size=0, writer_queue_size=0,
+                 overflow_policy='block', metrics_interval=None,
+                 log_traces=True, profile_signal=None):
         """
         Args:
             root_folder: tensorboard file root folder
             max_processes: 0 to use thread instead of process
+            max_threads: number of writer threads if max_processes == 0.
+                Thread mode uses in-process queues, no IPC cost.
+            encoder_processes: if > 0, encode add_image and add_audio on a
+                dedicated pool of this many processes instead of on the
+                _WriterGroup that owns the writer
+            prewarm: start all the writer processes (or threads) right away
+                instead of lazily when the first record for a new writer
+                arrives, to avoid the latency spike at experiment start.
+            start_method: multiprocessing start method for the writer and
+                encoder processes: 'fork', 'spawn' or 'forkserver'.
+                None for the platform default. 'forkserver' preloads
+                tensorboardX in the fork server and avoids forking a server
+                process that holds big state. With 'spawn' and 'forkserver',
+                your main script must be guarded by `if __name__ == '__main__'`
+            rotate_bytes: per writer, close the current event file and start a
+                new one in the same folder once it exceeds this many bytes.
+                TensorBoard stitches the files in a folder together.
+            rotate_secs: per writer, start a new event file every rotate_secs
+            ingest_queue_size: max records buffered between the ZMQ receiver
+                and the dispatch loop of start_server(), 0 for unbounded
+            writer_queue_size: max records queued per writer process (or
+                thread), 0 for unbounded. Also bounds the records held by
+                the encoder processes, which can only drop the newest.
+                Both queues have two lanes, each bounded by the queue size:
+                scalars, text and raw histograms are scheduled ahead of
+                images, audio, embeddings and histograms, which are still
+                served at least once every few fast records.
+            overflow_policy: what to do with a new record when a bounded
+                queue is full. Either one policy for all the add_* methods, or
+                a dict {method name: policy} (unlisted methods block):
+                - 'block': wait, applies backpressure to the clients
+                - 'drop_newest': drop the new record
+                - 'drop_oldest': drop the oldest queued record of the same
+                    method
+                - 'drop_low_priority': drop the oldest queued record of lower
+                    priority (images and embeddings < histograms < scalars
+                    and text), or the new record if there is none
+                Writer process queues can only drop the newest record.
+                Drop counts per client and tag are logged as curves under
+                <root>/tensorplex/, whose records are never dropped
+            metrics_interval: if not None, start_server() logs metrics about
+                the server itself every metrics_interval seconds, as curves
+                under <root>/tensorplex/: ingested records, bytes and batch
+                size, ingest queue depth, and the queue depth and processing
+                rate of every writer process
+            log_traces: False to not log the trace percentiles, and read them
+                with pop_trace_percentiles() instead
+            profile_signal: e.g. signal.SIGUSR1, sending it to the server
+                process toggles start_profiling() / stop_profiling().
+                start_server() must then run in the main thread, or it
+                raises.
+
+        Clients created with `trace_rate` > 0 send sampled records through
+        the pipeline with timestamps: per-stage latency percentiles are logged
+        as curves under <root>/tensorplex/trace/, see also dump_traces().
         """
+        check_overflow_policy(overflow_policy)
         self.folder = os.path.expanduser(root_folder)
         mkdir(self.folder)
         assert os.path.exists(self.folder), 'cannot create folder '+self.folder
@@ -207,17 +1128,342 @@ class Tensorplex(object):
         self._indexed_bin_size = {}
         self.combined_groups = []
         self._combined_tag_to_bin_name = {}
+        self._rotate_options = {
+            'rotate_bytes': rotate_bytes,
+            'rotate_secs': rotate_secs,
+        }
+        self._group_writer_options = {}  # group: kwargs dict for _Writer
+        self._aggregators = {}  # indexed group: StepAggregator
+        self._aggregate_only = {}  # indexed group: bool
+        self._sampler = Sampler()
+        # client_id: (client_tag, writerID), see _get_client_tag()
+        self._route_cache = {}
+        # client_id: (group, ID) if the group is aggregated else None
+        self._aggregate_route_cache = {}
+        self._ingest_queue_size = ingest_queue_size
+        self._overflow_policy = overflow_policy
+        self._drops = DropCounter()
+        self._logged_drops = {}  # (client, tag): last logged drop count
+        # bad records caught by the start_server() dispatch loop
+        self._dispatch_errors = ErrorCounter('Tensorplex')
+        self._logged_errors = {}
+        self._start_time = time.time()
+        self._ingest_id = None  # index of the ingest process, if several
+        self._logged_restarts = 0
+        self._next_periodic = 0.
+        self._next_counter_log = self._start_time + self._COUNTER_LOG_INTERVAL
+        self._metrics_interval = metrics_interval
+        self._ingest_server = None  # ZmqQueueServer, set by start_server()
+        self._last_metrics_time = self._start_time
+        self._last_ingest_counts = (0, 0, 0)
+        self._last_taken = {}  # writer process index: items taken
+        self._traces = TraceStats()
+        self._log_traces = log_traces
+        self._profile_signal = profile_signal
+        self._profiler = ThreadProfiler(
+            os.path.join(self.folder, _SYSTEM_WRITER, 'profiles')
+        )
+        # (on, include writers), applied by the dispatch loop
+        self._profile_request = None
 
         self._process_pool = _ProcessPool(
             root_folder=root_folder,
             max_processes=max_processes,
+            max_threads=max_threads,
+            encoder_processes=encoder_processes,
+            start_method=start_method,
+            prewarm=prewarm,
+            writer_options_fn=self._writer_options,
+            queue_size=writer_queue_size,
+            overflow_policy=overflow_policy,
+            on_drop=self._on_writer_drop,
+            errors=self._dispatch_errors,
         )
 
-    def register_normal_group(self, name):
+    def _make_ingest_queue(self):
+        """
+        Returns:
+            DropQueue for ZmqQueueServer, with priority lanes so that the
+            dispatch loop handles scalars ahead of queued images
+        """
+        return DropQueue(
+            self._ingest_queue_size,
+            kind_fn=lambda record: record[0],  # method name
+            overflow_policy=self._overflow_policy,
+            on_drop=self._on_ingest_drop,
+            lane_fn=lambda record: record_lane(record[0]),
+        )
+
+    def _on_ingest_drop(self, record):
+        method_name, client_id, args, kwargs = record[:4]  # may be traced
+        self._drops.count(str(client_id), _record_tag(args, kwargs))
+
+    def _on_writer_drop(self, writerID, writer_args):
+        method_name, client_tag, args, kwargs = writer_args
+        self._drops.count(writerID, _record_tag(args, kwargs))
+
+    def _on_aggregate_drop(self, group, ID, tag):
+        "a value that came after its step was reduced"
+        self._drops.count('{}/{}'.format(group, ID), tag)
+
+    def _log_system(self, section, tag, value):
+        """
+        Write a curve about the server itself to <root>/tensorplex/,
+        the step is the number of seconds since the server started.
+        """
+        if self._ingest_id is not None:
+            tag = 'ingest{}/{}'.format(self._ingest_id, tag)
+        self._process_pool.submit(
+            _SYSTEM_WRITER,
+            ('add_scalar', section,
+             (tag, value, int(time.time() - self._start_time)), {})
+        )
+
+    def _log_counts(self, section, counter, logged):
+        """
+        Log the counts of a DropCounter or ErrorCounter that changed since
+        the last call.
+
+        Args:
+            logged: {key: last logged count}, updated in place
+        """
+        counts = counter.snapshot()
+        if not counts:
+            return
+        for key, count in counts.items():
+            if logged.get(key) != count:
+                self._log_system(section, '/'.join(key), count)
+                logged[key] = count
+        self._log_system(section, 'total', sum(counts.values()))
+
+    def _periodic(self):
+        """
+        Housekeeping, called by the server dispatch loop after every record
+        and when idle. Cheap unless an interval has elapsed.
+        """
+        if self._profile_request is not None:
+            self._apply_profile_request()
+        now = time.time()
+        if now < self._next_periodic:
+            return
+        self._next_periodic = now + self._PERIODIC_INTERVAL
+        for group, aggregator in self._aggregators.items():
+            self._submit_aggregates(group, aggregator.expire(now))
+        for trace in self._process_pool.completed_traces():
+            self._traces.add(trace)
+        if now >= self._next_counter_log:
+            self._next_counter_log = now + self._COUNTER_LOG_INTERVAL
+            self._log_counts('drops', self._drops, self._logged_drops)
+            self._log_counts('dispatch_errors', self._dispatch_errors,
+                             self._logged_errors)
+            if self._log_traces:
+                self._log_trace_percentiles()
+        if (self._metrics_interval is not None
+                and now - self._last_metrics_time >= self._metrics_interval):
+            self._log_metrics(now)
+        num_restarts = self._process_pool.num_restarts
+        if num_restarts != self._logged_restarts:
+            self._logged_restarts = num_restarts
+            self._log_system('supervisor', 'writer_restarts', num_restarts)
+
+    def _on_profile_signal(self, signum, frame):
+        "toggles profiling, see `profile_signal`"
+        if self._profile_request is not None:
+            on = not self._profile_request[0]
+        else:
+            on = not self._profiler.active
+        # with several ingest processes, all of them get the signal and
+        # ingest 0 alone toggles the writers
+        self._profile_request = (on, not self._ingest_id)
+
+    def _apply_profile_request(self):
+        "in the dispatch thread, the one that cProfile must see"
+        on, include_writers = self._profile_request
+        self._profile_request = None
+        if include_writers:
+            self._process_pool.set_profiling(on)
+        if on:
+            if not self._profiler.start():
+                print('Tensorplex server cannot profile, another profiler is '
+                      'active in the process')
+            return
+        if self._ingest_id is None:
+            name = 'server'
+        else:
+            name = 'ingest{}'.format(self._ingest_id)
+        path = self._profiler.stop(name)
+        if path is not None:
+            print('Tensorplex server profile saved to', path)
+
+    def _log_trace_percentiles(self):
+        for name, values in self._traces.pop_percentiles().items():
+            for percentile, value in zip(PERCENTILES, values):
+                self._log_system(
+                    'trace', '{}_p{}'.format(name, percentile), value
+                )
+
+    def pop_trace_percentiles(self):
+        """
+        Per-stage latency percentiles of the sampled records completed since
+        the last call, in the server process. Completed traces are collected
+        by the dispatch loop once per second. Unless `log_traces` is False,
+        the periodic logging pops them too.
+
+        Returns:
+            {stage name: [p50, p90, p99] in seconds}
+        """
+        return self._traces.pop_percentiles()
+
+    def stats(self):
+        """
+        Snapshot of the server counters, in the process that runs
+        start_server(), e.g. for benchmarks.
+
+        Returns:
+            {'ingest': None until start_server() listens, else a dict
+                'messages', 'records', 'bytes': received so far
+                'queue_depth': records waiting for the dispatch loop
+             'writers': a dict for each writer process (or thread)
+                'pid': None in thread mode
+                'queue_depth': records queued per lane, None on macOS
+                'taken': records taken per lane, restarts from 0 if the
+                    process is restarted}
+        """
+        server = self._ingest_server
+        ingest = None
+        if server is not None:
+            ingest = {
+                'messages': server.num_messages,
+                'records': server.num_records,
+                'bytes': server.num_bytes,
+                'queue_depth': server.qsize(),
+            }
+        writers = [
+            {'pid': pid, 'queue_depth': depths, 'taken': taken}
+            for pid, (depths, taken) in zip(self._process_pool.writer_pids(),
+                                             self._process_pool.queue_stats())
+        ]
+        return {'ingest': ingest, 'writers': writers}
+
+    def _log_metrics(self, now):
+        "server self-instrumentation, see `metrics_interval`"
+        dt = now - self._last_metrics_time
+        self._last_metrics_time = now
+        server = self._ingest_server
+        if server is not None:
+            counts = (server.num_messages, server.num_records, server.num_bytes)
+            messages, records, num_bytes = [
+                count - last
+                for count, last in zip(counts, self._last_ingest_counts)
+            ]
+            self._last_ingest_counts = counts
+            self._log_system('ingest', 'records_per_sec', records / dt)
+            self._log_system('ingest', 'bytes_per_sec', num_bytes / dt)
+            if messages:
+                self._log_system('ingest', 'batch_size', records / messages)
+            self._log_system('ingest', 'queue_depth', server.qsize())
+        if self._ingest_id:
+            return  # writer processes are shared, ingest 0 reports them
+        stats = self._process_pool.queue_stats()
+        for idx, (depths, taken) in enumerate(stats):
+            writer = 'writer{}'.format(idx)
+            if depths is not None:
+                for lane, depth in enumerate(depths):
+                    self._log_system(
+                        writer, 'queue_depth_' + LANE_NAMES[lane], depth
+                    )
+            taken = sum(taken)
+            # the count restarts from 0 if the process is restarted
+            rate = max(taken - self._last_taken.get(idx, 0), 0) / dt
+            self._last_taken[idx] = taken
+            self._log_system(writer, 'records_per_sec', rate)
+
+    def _add_metrics(self, metrics):
+        "Prometheus metrics, see start_server()"
+        metrics.counter(
+            'dropped_records_total', 'records dropped by a full queue',
+            [({'client': client, 'tag': tag}, count)
+             for (client, tag), count in self._drops.snapshot().items()]
+        )
+        metrics.counter(
+            'dispatch_errors_total', 'records that failed to dispatch',
+            [({'client_id': client_id, 'error': error}, count)
+             for (client_id, error), count
+             in self._dispatch_errors.snapshot().items()]
+        )
+        depths = []
+        processed = []
+        for idx, (lane_depths, taken) in enumerate(
+                self._process_pool.queue_stats()):
+            if lane_depths is not None:
+                for lane, depth in enumerate(lane_depths):
+                    depths.append(
+                        ({'writer': idx, 'lane': LANE_NAMES[lane]}, depth)
+                    )
+            processed.append(({'writer': idx}, sum(taken)))
+        metrics.gauge('writer_queue_depth',
+                      'records queued per writer process and lane', depths)
+        metrics.counter('writer_processed_total',
+                        'records taken by each writer process since its '
+                        'last start', processed)
+        metrics.counter('writer_restarts_total',
+                        'writer processes restarted after dying',
+                        self._process_pool.num_restarts)
+        for name in LATENCY_NAMES:
+            metrics.histogram('trace_{}_seconds'.format(name),
+                              'sampled records, ' + LATENCY_HELP[name],
+                              self._traces.histograms[name])
+
+    def _prepare_ingest_processes(self):
+        """
+        Before forking several ingest processes, see start_server().
+        Each of them routes records straight to the _WriterGroup that owns
+        the writer, so all the groups must be registered by now.
+        """
+        assert not self._aggregators, \
+            'aggregated groups require a single ingest process'
+        self._process_pool.enable_hash_routing()
+
+    def _after_fork(self, ingest_id):
+        "in the forked ingest process"
+        self._ingest_id = ingest_id
+        self._process_pool.after_fork()
+
+    def _check_group_name(self, name):
+        assert name != _SYSTEM_WRITER, \
+            'group name "{}" is reserved'.format(_SYSTEM_WRITER)
+
+    def _writer_options(self, writerID):
+        "kwargs for each new _Writer, writerID is either <group> or <group>/<id>"
+        group = writerID.split('/')[0]
+        options = dict(self._rotate_options)
+        options.update(self._group_writer_options.get(group, {}))
+        return options
+
+    def _set_group_writer_options(self, name, flush_secs, max_queue):
+        self._group_writer_options[name] = {
+            'flush_secs': flush_secs,
+            'max_queue': max_queue,
+        }
+
+    def register_normal_group(self, name, flush_secs=None, max_queue=None):
+        """
+        Args:
+            name: group name
+            flush_secs: how often the group's event files are flushed to disk.
+                Low for near-real-time curves, high to save I/O.
+                None for the tensorboardX default (120)
+            max_queue: number of pending events before a forced flush.
+                None for the tensorboardX default (10)
+        """
+        self._check_group_name(name)
         self.normal_groups.append(name)
+        self._set_group_writer_options(name, flush_secs, max_queue)
+        self.clear_route_cache()
         return self
 
-    def register_combined_group(self, name, tag_to_bin_name):
+    def register_combined_group(self, name, tag_to_bin_name,
+                                flush_secs=None, max_queue=None):
         """
         Args:
             name: group name, will create a subfolder for the group
@@ -233,13 +1479,20 @@ class Tensorplex(object):
                         return ':fruit'
                 Your graph will then have 3 curves under "mygroup.color"
                 2 curves under "mygroup.fruit", and 4 under "mygroup/alphabet"
+            flush_secs: see register_normal_group()
+            max_queue: see register_normal_group()
         """
         assert callable(tag_to_bin_name)
+        self._check_group_name(name)
         self.combined_groups.append(name)
         self._combined_tag_to_bin_name[name] = tag_to_bin_name
+        self._set_group_writer_options(name, flush_secs, max_queue)
+        self.clear_route_cache()
         return self
 
-    def register_indexed_group(self, name, bin_size):
+    def register_indexed_group(self, name, bin_size,
+                               flush_secs=None, max_queue=None,
+                               aggregate=None, aggregate_window=10.):
         """
         Args:
             name: group name, will create a subfolder for the group
@@ -249,10 +1502,34 @@ class Tensorplex(object):
                 "0-9", process 22 will be assigned to the third bin "20-29",
                 process 42 will be assigned to the last bin "40-49"
                 You don't need to know the total number of processes in advance.
+            flush_secs: see register_normal_group()
+            max_queue: see register_normal_group()
+            aggregate: None, 'both' or 'only'.
+                Reduce add_scalar values across all members of the group at
+                every step, and write mean/median/p10/p90 curves to
+                <root>/<name>/aggregate/<stat>/. They show up as 4 curves in
+                the "<name>/<tag>/aggregate" graph.
+                'both' keeps the per-member curves as well, 'only' drops them,
+                which shrinks TensorBoard load time and disk usage by the
+                group size.
+            aggregate_window: a step is reduced as soon as all the members seen
+                so far have reported it, or after this many seconds. Values
+                that come after their step was reduced are counted as drops.
         """
         assert isinstance(bin_size, int) and bin_size > 0
+        assert aggregate in [None, 'both', 'only'], \
+            'aggregate must be None, "both" or "only"'
+        self._check_group_name(name)
         self.indexed_groups.append(name)
         self._indexed_bin_size[name] = bin_size
+        self._set_group_writer_options(name, flush_secs, max_queue)
+        if aggregate is not None:
+            self._aggregators[name] = StepAggregator(
+                aggregate_window,
+                on_drop=partial(self._on_aggregate_drop, name),
+            )
+            self._aggregate_only[name] = aggregate == 'only'
+        self.clear_route_cache()
         return self
 
     def _index_bin_name(self, group, ID):
@@ -276,7 +1553,58 @@ class Tensorplex(object):
             'returned bin_name {} must be a string'.format(bin_name)
         return bin_name
 
+    def register_sampling_rule(self, group='*', tag='*',
+                               every_k=None, max_points=None, interval=None,
+                               on_change=False):
+        """
+        Thin out records at ingestion, before they are sent to the writer
+        processes, e.g. for legacy clients that log every single step.
+        The first registered rule that matches a record's group and tag
+        applies, records that match no rule are always kept.
+        All the specified conditions of a rule must hold to keep a record.
+
+        Args:
+            group: fnmatch pattern of the group name, e.g. 'agent'
+            tag: fnmatch pattern of the tag as sent by the client, e.g. 'loss*'
+            every_k: keep only the steps that are a multiple of every_k
+            max_points: keep at most max_points per `interval` seconds,
+                per client and tag
+            interval: seconds, see max_points
+            on_change: keep a scalar only if its value changed
+        """
+        self._sampler.add_rule(SamplingRule(
+            group=group,
+            tag=tag,
+            every_k=every_k,
+            max_points=max_points,
+            interval=interval,
+            on_change=on_change,
+        ))
+        return self
+
+    def clear_route_cache(self):
+        """
+        Client routing is resolved once per client_id and cached. Called
+        automatically when a group is registered. Call it manually if you
+        mutate the groups in any other way, e.g. if `tag_to_bin_name` of a
+        combined group is not a pure function.
+        """
+        self._route_cache.clear()
+        self._aggregate_route_cache.clear()
+
     def _get_client_tag(self, client_id):
+        """
+        Cached version of _resolve_client_tag(), the hot path of every record
+        is a single dict lookup.
+        """
+        try:
+            return self._route_cache[client_id]
+        except KeyError:
+            route = self._resolve_client_tag(client_id)
+            self._route_cache[client_id] = route
+            return route
+
+    def _resolve_client_tag(self, client_id):
         """
         Client ID needs to be in the form of "<group>/<id>"
         For NumberedGroup, <id> must be an int, the group will be placed into bins
@@ -325,7 +1653,55 @@ class Tensorplex(object):
                 raise ValueError('Group "{}" not found. Available groups: {}'
                                  .format(group, all_groups))
 
-    def add_scalars(self, tag_scalar_dict, global_step, *, _client_id_):
+    def _get_aggregate_route(self, client_id):
+        """
+        Returns:
+            (group, ID) if the client belongs to an aggregated group else None
+        """
+        try:
+            return self._aggregate_route_cache[client_id]
+        except KeyError:
+            group, ID = client_id.split('/')
+            route = (group, ID) if group in self._aggregators else None
+            self._aggregate_route_cache[client_id] = route
+            return route
+
+    def _aggregate_scalars(self, client_id, tag, values, steps):
+        """
+        Feed the aggregator of the client's indexed group, if any.
+
+        Returns:
+            True if the per-member curve should be dropped
+        """
+        route = self._get_aggregate_route(client_id)
+        if route is None:
+            return False
+        group, ID = route
+        aggregator = self._aggregators[group]
+        for value, step in zip(values, steps):
+            if step is None:  # cannot align without a step
+                continue
+            self._submit_aggregates(
+                group, aggregator.add(ID, tag, step, float(value))
+            )
+        return self._aggregate_only[group]
+
+    def _submit_aggregates(self, group, completed):
+        for tag, step, stats in completed:
+            for stat in AGGREGATE_STATS:
+                self._process_pool.submit(
+                    '{}/aggregate/{}'.format(group, stat),
+                    ('add_scalar', (group, 'aggregate'),
+                     (tag, stats[stat], step), {})
+                )
+
+    def flush_aggregates(self):
+        "write out all the pending aggregate steps, even if incomplete"
+        for group, aggregator in self._aggregators.items():
+            self._submit_aggregates(group, aggregator.flush())
+
+    def add_scalars(self, tag_scalar_dict, global_step, *, _client_id_,
+                    _trace_=None):
         """
         Tensorplex's add_scalars() is simply calling add_scalar() multiple times.
         It is NOT the same as `add_scalars()` in the original Tensorboard-pytorch
@@ -338,25 +1714,114 @@ class Tensorplex(object):
                 tag,
                 value,
                 global_step=global_step,
-                _client_id_=_client_id_
+                _client_id_=_client_id_,
+                _trace_=_trace_
             )
+            _trace_ = None  # follows the first value only
+
+    def add_scalar_array(self, tag, values, steps, walltimes=None,
+                         *, _client_id_, _trace_=None):
+        """
+        Bulk version of add_scalar(): values[i] is logged at steps[i].
+        The whole array travels as one record instead of one per value.
+
+        Args:
+            tag: same as add_scalar()
+            values: 1D array of floats
+            steps: 1D array of ints, same length as values
+            walltimes: optional 1D array of floats (seconds since epoch),
+                defaults to the time the writer emits the values
+        """
+        values, steps, walltimes = check_scalar_array(values, steps, walltimes)
+        client_tag, writerID = self._get_client_tag(_client_id_)
+        if self._sampler.active:
+            state = self._sampler.get_state(_client_id_, tag)
+            if state is not None:
+                mask = state.keep_mask(steps, values, time.time())
+                if not mask.all():
+                    values, steps = values[mask], steps[mask]
+                    if walltimes is not None:
+                        walltimes = walltimes[mask]
+                    if not len(values):
+                        return
+        if (self._aggregators and self._aggregate_scalars(
+                _client_id_, tag, values.tolist(), steps.tolist())):
+            return
+        self._process_pool.submit(
+            writerID,
+            ('add_scalar_array', client_tag,
+             (tag, values, steps, walltimes), {}),
+            trace=_trace_
+        )
 
     def export_json(self, json_dir):
         """
-        Format: {writer_id : [[timestamp, step, value], ...] ...}
-        Save to <root>/<json_dir>
+        All the scalars written so far, read back from the event files.
+        One file per writer, <root>/<json_dir>/<writerID>.json
+        Format: {tag : [[timestamp, step, value], ...] ...}
         """
+        self.flush_aggregates()
         json_dir = os.path.expanduser(os.path.join(self.folder, json_dir))
         mkdir(json_dir)
-        for writerID in self._process_pool.all_writer_ids():
-            json_path = os.path.join(
-                json_dir,
-                writerID.replace('/', '.')+'.json'
-            )
-            self._process_pool.submit(
-                writerID,
-                ('export_json', None, (json_path,), {})
-            )
+        self._process_pool.broadcast(
+            _ExportRequest(export_dir=json_dir, format='json', chunk_size=None)
+        )
+
+    def export(self, export_dir, format='npz', chunk_size=65536):
+        """
+        Columnar alternative to export_json(), much faster to load into pandas.
+        One file per writer, written in parallel by each _WriterGroup.
+        Columns: writer, tag, step, wall_time, value
+
+        Args:
+            export_dir: save to <root>/<export_dir>
+            format: 'npz' (numpy) or 'parquet' (requires pyarrow)
+            chunk_size: number of rows streamed at a time, bounds the writer
+                process memory
+        """
+        check_export_format(format)
+        self.flush_aggregates()
+        export_dir = os.path.expanduser(os.path.join(self.folder, export_dir))
+        mkdir(export_dir)
+        self._process_pool.broadcast(
+            _ExportRequest(export_dir=export_dir, format=format,
+                           chunk_size=chunk_size)
+        )
+
+    def dump_traces(self, json_path):
+        """
+        Save the per-stage latency histograms of all the sampled records
+        so far to <root>/<json_path>, see TensorplexClient `trace_rate`.
+        With several ingest processes, each one aggregates a share of the
+        traces and only the one that receives the call dumps, to
+        <root>/<json_path>.ingest<i>
+        """
+        for trace in self._process_pool.completed_traces():
+            self._traces.add(trace)
+        json_path = os.path.expanduser(os.path.join(self.folder, json_path))
+        if self._ingest_id is not None:
+            json_path += '.ingest{}'.format(self._ingest_id)
+        mkdir(os.path.dirname(json_path))
+        self._traces.dump(json_path)
+
+    def start_profiling(self):
+        """
+        Start cProfile in the dispatch loop of the server and in every writer
+        process (or thread), see stop_profiling(). Takes effect within a
+        second, ahead of the records already queued. Can be called from a
+        client, or triggered by `profile_signal`.
+        """
+        self._profile_request = (True, True)
+
+    def stop_profiling(self):
+        """
+        Stop profiling, each process dumps its stats to
+        <root>/tensorplex/profiles/<name>.<pid>.<start time>.prof where name
+        is 'server' (or 'ingest<i>') and 'writer<i>'.
+        With several ingest processes, a client call only reaches the ingest
+        process of that client, use `profile_signal` to profile all of them.
+        """
+        self._profile_request = (False, True)
 
     def proxy(self, client_id):
         return LocalProxy(self, client_id,
@@ -367,12 +1832,55 @@ class Tensorplex(object):
         self._process_pool.print_done()
 
 
+def _arg_getter(func, names):
+    """
+    Cheaper than binding the signature of `func` for every record.
+
+    Returns:
+        (args, kwargs) -> list of the values of the `names` arguments, their
+        default (None if they have none) if they are not passed
+    """
+    params = list(inspect.signature(func).parameters.values())[1:]  # self
+    positions = {param.name: i for i, param in enumerate(params)}
+    specs = []
+    for name in names:
+        default = params[positions[name]].default
+        if default is inspect.Parameter.empty:
+            default = None
+        specs.append((name, positions[name], default))
+
+    def get(args, kwargs):
+        return [args[i] if i < len(args) else kwargs.get(name, default)
+                for name, i, default in specs]
+    return get
+
+
 def _wrap_method(method_name, old_method):
-    def _method(self, *args, _client_id_, **kwargs):
+    is_scalar = method_name == 'add_scalar'
+    if is_scalar:
+        get_args = _arg_getter(old_method,
+                               ['tag', 'global_step', 'scalar_value'])
+    else:
+        get_args = _arg_getter(old_method, ['tag', 'global_step'])
+
+    def _method(self, *args, _client_id_, _trace_=None, **kwargs):
         client_tag, writerID = self._get_client_tag(_client_id_)
+        if self._sampler.active:
+            tag, step, *scalar_value = get_args(args, kwargs)
+            state = self._sampler.get_state(_client_id_, tag)
+            if state is not None:
+                value = scalar_value[0] if scalar_value else None
+                if not state.keep(step, value, time.time()):
+                    return
+        if (is_scalar and self._aggregators
+                and self._get_aggregate_route(_client_id_) is not None):
+            tag, step, value = get_args(args, kwargs)
+            if self._aggregate_scalars(_client_id_, tag, [value], [step]):
+                return
         self._process_pool.submit(
             writerID,
-            (method_name, client_tag, args, kwargs)
+            (method_name, client_tag, args, kwargs),
+            trace=_trace_
         )
     return _method
 
@@ -2,14 +2,44 @@ from .utils import *
 from .zmq_queue import *
 from .local_loggerplex import Loggerplex
 from .logger import Logger
+from .metrics import MetricsText, add_ingest_metrics, start_metrics_server
+import time
 
 
-def start_loggerplex_server(loggerplex, port):
-    q = ZmqQueueServer(port=port, is_batched=True)
+def start_loggerplex_server(loggerplex, port, metrics_port=None):
+    """
+    Blocks forever.
+
+    Args:
+        metrics_port: if not None, serve Prometheus metrics on
+            http://<host>:<metrics_port>/metrics, from a background thread
+    """
+    errors = ErrorCounter('Loggerplex')
+    q = ZmqQueueServer(port=port, is_batched=True, errors=errors)
+    loggerplex._ingest_server = q
+    last_seen = {}  # client_id: time of the last record
+    if metrics_port is not None:
+        def collect():
+            metrics = MetricsText('loggerplex_')
+            add_ingest_metrics(metrics, q, last_seen)
+            metrics.counter(
+                'dispatch_errors_total', 'records that failed to dispatch',
+                [({'client_id': client_id, 'error': error}, count)
+                 for (client_id, error), count in errors.snapshot().items()]
+            )
+            return metrics
+        start_metrics_server(metrics_port, collect)
     while True:
-        method_name, client_id, args, kwargs = q.dequeue()
-        tplex_method = getattr(loggerplex, method_name)
-        tplex_method(*args, _client_id_=client_id, **kwargs)
+        record = q.dequeue()
+        client_id = None  # if the record is malformed
+        try:
+            method_name, client_id, args, kwargs = record
+            last_seen[client_id] = time.time()
+            tplex_method = getattr(loggerplex, method_name)
+            tplex_method(*args, _client_id_=client_id, **kwargs)
+        except Exception as e:
+            # one bad record must not stop ingestion for everybody
+            errors.count(client_id, e)
 
 
 class LoggerplexClient(object):
@@ -93,7 +123,8 @@ delegate_methods(
     target_obj=LoggerplexClient,
     src_obj=Loggerplex,
     wrapper=_method_wrapper,
-    doc_signature=False
+    doc_signature=False,
+    exclude=Loggerplex._EXCLUDE_METHODS
 )
 
 
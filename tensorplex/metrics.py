@@ -0,0 +1,151 @@
+"""
+Prometheus text endpoint for the tensorplex and loggerplex servers.
+Implements the few counters, gauges and histograms we need without depending
+on prometheus_client. Metrics are only rendered when scraped, on a separate
+thread, and never lock anything that the ingest thread uses.
+"""
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+
+DECODE_TIME_BUCKETS = [1e-5, 5e-5, 1e-4, 5e-4, 1e-3, 5e-3, 1e-2, 5e-2, 0.1, 1.]
+BATCH_SIZE_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000]
+
+
+class Histogram(object):
+    """
+    Updated by a single thread. Readers on other threads may see a snapshot
+    that is off by the observation in progress, which is fine for monitoring.
+    """
+    def __init__(self, buckets):
+        """
+        Args:
+            buckets: sorted upper bounds, +Inf is implicit
+        """
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(
+            key,
+            str(value).replace('\\', r'\\').replace('"', r'\"')
+                      .replace('\n', r'\n')
+        )
+        for key, value in labels.items()
+    ) + '}'
+
+
+class MetricsText(object):
+    "builds a page in the Prometheus text exposition format"
+    def __init__(self, prefix):
+        self._prefix = prefix
+        self._lines = []
+
+    def _header(self, name, kind, help):
+        name = self._prefix + name
+        self._lines.append('# HELP {} {}'.format(name, help))
+        self._lines.append('# TYPE {} {}'.format(name, kind))
+        return name
+
+    def _samples(self, name, kind, help, value):
+        """
+        Args:
+            value: a number, or a list of (labels dict, number)
+        """
+        name = self._header(name, kind, help)
+        if not isinstance(value, list):
+            value = [(None, value)]
+        for labels, v in value:
+            self._lines.append('{}{} {}'.format(name, _format_labels(labels),
+                                                float(v)))
+
+    def counter(self, name, help, value):
+        self._samples(name, 'counter', help, value)
+
+    def gauge(self, name, help, value):
+        self._samples(name, 'gauge', help, value)
+
+    def histogram(self, name, help, hist):
+        name = self._header(name, 'histogram', help)
+        counts = list(hist.counts)
+        cumulative = 0
+        for bound, count in zip(hist.buckets + ['+Inf'], counts):
+            cumulative += count
+            self._lines.append('{}_bucket{{le="{}"}} {}'
+                               .format(name, bound, float(cumulative)))
+        self._lines.append('{}_sum {}'.format(name, float(hist.sum)))
+        self._lines.append('{}_count {}'.format(name, float(cumulative)))
+
+    def text(self):
+        return '\n'.join(self._lines) + '\n'
+
+
+def add_ingest_metrics(metrics, server, last_seen):
+    """
+    Metrics common to the tensorplex and loggerplex servers
+
+    Args:
+        metrics: MetricsText
+        server: ZmqQueueServer
+        last_seen: {client_id: time of the last record}
+    """
+    metrics.counter('ingested_messages_total',
+                    'ZMQ messages received', server.num_messages)
+    metrics.counter('ingested_records_total',
+                    'records received', server.num_records)
+    metrics.counter('ingested_bytes_total',
+                    'bytes received', server.num_bytes)
+    metrics.gauge('ingest_queue_depth',
+                  'records waiting for the dispatch loop', server.qsize())
+    metrics.histogram('decode_seconds',
+                      'time to unpickle a message', server.decode_time)
+    metrics.histogram('batch_records',
+                      'records per message', server.batch_size)
+    metrics.gauge('client_last_seen_timestamp_seconds',
+                  'unix time of the last record from each client',
+                  [({'client_id': client_id}, t)
+                   for client_id, t in dict(last_seen).items()])
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    collect_fn = None  # set by start_metrics_server()
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.collect_fn().text().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # one line per scrape is just noise
+
+
+def start_metrics_server(port, collect_fn):
+    """
+    Serve http://<host>:<port>/metrics on a daemon thread
+
+    Args:
+        collect_fn: () -> MetricsText, called on every scrape
+    """
+    handler = type('MetricsHandler', (_MetricsHandler,),
+                   {'collect_fn': staticmethod(collect_fn)})
+    httpd = HTTPServer(('', port), handler)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return httpd
@@ -0,0 +1,65 @@
+"""
+cProfile hooks, to find the hot spots of a live server and of its writer
+processes without restarting the experiment, see Tensorplex.start_profiling().
+Load the dumped stats with `python -m pstats <file>` or snakeviz.
+"""
+import cProfile
+import os
+import time
+from .utils import mkdir
+
+
+class ThreadProfiler(object):
+    """
+    cProfile only sees the thread that enables it: start() and stop() must be
+    called from the thread to profile.
+    """
+    def __init__(self, profile_dir):
+        """
+        Args:
+            profile_dir: stats files are dumped there
+        """
+        self._profile_dir = profile_dir
+        self._profile = None
+        self._start_time = None
+
+    @property
+    def active(self):
+        return self._profile is not None
+
+    def start(self):
+        """
+        Returns:
+            False if another profiler is active in the process, which Python
+            3.12+ doesn't allow, e.g. several writer threads in thread mode
+        """
+        if self._profile is not None:
+            return True
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            return False
+        self._start_time = time.localtime()
+        self._profile = profile
+        return True
+
+    def stop(self, name):
+        """
+        Args:
+            name: of the profiled process, e.g. "writer3"
+
+        Returns:
+            path of the stats file, <profile_dir>/<name>.<pid>.<start time>.prof
+            None if not profiling
+        """
+        if self._profile is None:
+            return None
+        self._profile.disable()
+        mkdir(self._profile_dir)
+        path = os.path.join(self._profile_dir, '{}.{}.{}.prof'.format(
+            name, os.getpid(), time.strftime('%Y%m%d-%H%M%S', self._start_time)
+        ))
+        self._profile.dump_stats(path)
+        self._profile = None
+        return path
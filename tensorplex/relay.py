@@ -0,0 +1,142 @@
+"""
+Relay node: a lightweight per-host process that fans in the traffic of all the
+local TensorplexClient / LoggerplexClient and forwards it upstream over a
+single connection. Relays can point at other relays to form a tree, so that
+the central server sees one fat stream per host instead of one thin stream
+per client.
+
+Messages are forwarded as raw bytes, the relay never unpickles them.
+A relay forwards to a single port, so it doesn't support a server started
+with `ingest_processes > 1`.
+
+Usage on every host, pointing the local clients at port 7000:
+    tensorplex-relay 7000 central-host 8008
+"""
+import argparse
+import time
+import zmq
+from .zmq_queue import unpack_relay_frames, pack_relay_frames
+from .utils import ErrorCounter
+
+
+class ZmqRelay(object):
+    def __init__(self,
+                 port,
+                 upstream_host,
+                 upstream_port,
+                 flush_time=0.2,
+                 compress=False,
+                 max_batch_bytes=16 * 1024 * 1024):
+        """
+        Args:
+            port: port that the clients (or lower level relays) connect to
+            upstream_host: server or upper level relay
+            upstream_port:
+            flush_time: forward the merged batch every flush_time seconds
+            compress: zlib-compress the merged batch, trades relay CPU for
+                bandwidth between hosts
+            max_batch_bytes: forward early once this many bytes are buffered
+        """
+        context = zmq.Context()
+        self.in_socket = context.socket(zmq.PULL)
+        self.in_socket.set_hwm(100)
+        # must be tcp://*, see ZmqQueueServer
+        self.in_socket.bind("tcp://*:{}".format(port))
+        self.out_socket = context.socket(zmq.PUSH)
+        self.out_socket.set_hwm(100)
+        if upstream_host == 'localhost':
+            upstream_host = '127.0.0.1'
+        self.out_socket.connect(
+            "tcp://{}:{}".format(upstream_host, upstream_port)
+        )
+        self._flush_time = flush_time
+        self._compress = compress
+        self._max_batch_bytes = max_batch_bytes
+        self._frames = []
+        self._num_bytes = 0
+        # malformed messages, skipped
+        self.errors = ErrorCounter('Tensorplex relay')
+
+    def _unpack(self, parts):
+        "the client messages carried by parts, raises if malformed"
+        frames = unpack_relay_frames(parts)
+        for frame in frames:
+            if not isinstance(frame, bytes):
+                raise TypeError('expected bytes, got ' + type(frame).__name__)
+        return frames
+
+    def _flush(self):
+        if self._frames:
+            self.out_socket.send_multipart(
+                pack_relay_frames(self._frames, self._compress),
+                copy=False,
+            )
+            self._frames = []
+            self._num_bytes = 0
+
+    def run(self):
+        "blocks forever"
+        poller = zmq.Poller()
+        poller.register(self.in_socket, zmq.POLLIN)
+        next_flush = time.time() + self._flush_time
+        while True:
+            timeout = max(next_flush - time.time(), 0.)
+            if poller.poll(timeout * 1000):
+                # drain everything available without blocking
+                while True:
+                    try:
+                        parts = self.in_socket.recv_multipart(zmq.NOBLOCK)
+                    except zmq.Again:
+                        break
+                    # a bad message from one sender must not stop the
+                    # relay for the whole host, the sender is unknown here
+                    try:
+                        frames = self._unpack(parts)
+                    except Exception as e:
+                        self.errors.count(None, e)
+                        continue
+                    self._frames.extend(frames)
+                    self._num_bytes += sum(len(frame) for frame in frames)
+                    if self._num_bytes >= self._max_batch_bytes:
+                        self._flush()
+            if time.time() >= next_flush:
+                self._flush()
+                next_flush = time.time() + self._flush_time
+
+
+def start_relay(port, upstream_host, upstream_port,
+                flush_time=0.2, compress=False,
+                max_batch_bytes=16 * 1024 * 1024):
+    """
+    Blocks forever. Clients connect to the relay exactly as they would to the
+    server, i.e. `TensorplexClient(..., host=<relay host>, port=port)`,
+    with the default `ingest_processes=1`. See ZmqRelay for the arguments.
+    """
+    ZmqRelay(
+        port=port,
+        upstream_host=upstream_host,
+        upstream_port=upstream_port,
+        flush_time=flush_time,
+        compress=compress,
+        max_batch_bytes=max_batch_bytes,
+    ).run()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('port', type=int)
+    parser.add_argument('upstream_host')
+    parser.add_argument('upstream_port', type=int)
+    parser.add_argument('--flush-time', type=float, default=0.2)
+    parser.add_argument('--compress', action='store_true')
+    parser.add_argument('--max-batch-bytes', type=int,
+                        default=16 * 1024 * 1024,
+                        help='forward early once this many bytes are buffered')
+    args = parser.parse_args()
+    start_relay(args.port, args.upstream_host, args.upstream_port,
+                flush_time=args.flush_time, compress=args.compress,
+                max_batch_bytes=args.max_batch_bytes)
+
+
+if __name__ == '__main__':
+    main()
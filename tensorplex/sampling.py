@@ -0,0 +1,148 @@
+"""
+Server-side sampling of records, per group or tag pattern.
+Lets the server thin out clients that log far more often than anyone looks at,
+without touching the client code.
+"""
+import fnmatch
+import numbers
+import numpy as np
+
+
+class SamplingRule(object):
+    """
+    All the specified conditions must hold for a record to be kept.
+    """
+    def __init__(self, group='*', tag='*',
+                 every_k=None, max_points=None, interval=None,
+                 on_change=False):
+        """
+        Args:
+            group: fnmatch pattern for the group name
+            tag: fnmatch pattern for the tag, as sent by the client
+            every_k: keep only the steps that are a multiple of k.
+                Records without a step are counted instead.
+            max_points: keep at most max_points per `interval` seconds,
+                per client and tag
+            interval: see max_points
+            on_change: keep a scalar only if it differs from the last kept
+                value of the same client and tag
+        """
+        assert every_k is None or (isinstance(every_k, int) and every_k > 0)
+        assert (max_points is None) == (interval is None), \
+            'max_points and interval must be specified together'
+        self.group = group
+        self.tag = tag
+        self.every_k = every_k
+        self.max_points = max_points
+        self.interval = interval
+        self.on_change = on_change
+
+    def matches(self, group, tag):
+        return (fnmatch.fnmatchcase(group, self.group)
+                and fnmatch.fnmatchcase(tag, self.tag))
+
+
+class _SamplerState(object):
+    "per (client_id, tag) state of a rule"
+    def __init__(self, rule):
+        self.rule = rule
+        self.count = 0  # for records without steps
+        self.window_start = 0.
+        self.window_count = 0
+        self.last_value = None
+
+    def keep(self, step, value, now):
+        rule = self.rule
+        if rule.every_k is not None:
+            if step is None:
+                self.count += 1
+                step = self.count - 1
+            if step % rule.every_k != 0:
+                return False
+        if rule.on_change and isinstance(value, numbers.Number):
+            if value == self.last_value:
+                return False
+        if rule.max_points is not None:
+            if now - self.window_start >= rule.interval:
+                self.window_start = now
+                self.window_count = 0
+            if self.window_count >= rule.max_points:
+                return False
+            self.window_count += 1
+        if rule.on_change:
+            self.last_value = value
+        return True
+
+    def keep_mask(self, steps, values, now):
+        "vectorized keep() for add_scalar_array"
+        rule = self.rule
+        mask = np.ones(len(steps), dtype=bool)
+        if rule.every_k is not None:
+            mask &= steps % rule.every_k == 0
+        if rule.on_change:
+            # among the candidates, a value equal to the previous candidate is
+            # also equal to the last kept value
+            idx = np.flatnonzero(mask)
+            candidates = values[idx]
+            prev = np.empty_like(candidates)
+            if len(candidates):
+                prev[0] = (np.nan if self.last_value is None
+                           else self.last_value)
+                prev[1:] = candidates[:-1]
+            mask[idx[candidates == prev]] = False
+        # like keep(), the window only starts with a candidate record
+        if rule.max_points is not None and mask.any():
+            if now - self.window_start >= rule.interval:
+                self.window_start = now
+                self.window_count = 0
+            budget = max(rule.max_points - self.window_count, 0)
+            kept = np.flatnonzero(mask)[:budget]
+            mask[:] = False
+            mask[kept] = True
+            self.window_count += len(kept)
+        if rule.on_change and mask.any():
+            self.last_value = float(values[mask][-1])
+        return mask
+
+
+class Sampler(object):
+    """
+    The first registered rule that matches a (group, tag) applies.
+    The rule lookup is resolved once per (client_id, tag) and cached.
+    """
+    # bounded, e.g. if tags embed a step. Clearing restarts the every_k counts
+    # and max_points windows, which only lets a few more records through.
+    _STATE_CACHE_SIZE = 16384
+
+    def __init__(self):
+        self._rules = []
+        self._states = {}  # (client_id, tag): _SamplerState or None
+
+    @property
+    def active(self):
+        return bool(self._rules)
+
+    def add_rule(self, rule):
+        self._rules.append(rule)
+        self._states.clear()
+
+    def get_state(self, client_id, tag):
+        """
+        Returns:
+            _SamplerState, or None if no rule applies
+        """
+        key = (client_id, tag)
+        try:
+            return self._states[key]
+        except KeyError:
+            pass
+        group = client_id.split('/')[0]
+        state = None
+        for rule in self._rules:
+            if rule.matches(group, tag):
+                state = _SamplerState(rule)
+                break
+        if len(self._states) >= self._STATE_CACHE_SIZE:
+            self._states.clear()
+        self._states[key] = state
+        return state
@@ -1,48 +1,228 @@
 from .utils import *
 from .zmq_queue import *
-from .local_tensorplex import Tensorplex
+from .local_tensorplex import Tensorplex, check_scalar_array
+from .histogram import compute_histogram
+from .metrics import MetricsText, add_ingest_metrics, start_metrics_server
+import multiprocessing as mp
+import os
+import queue
+import random
+import signal
+import threading
+import time
+import zlib
 
 
-def start_tensorplex_server(tensorplex, port):
-    q = ZmqQueueServer(port=port, is_batched=True)
+def ingest_port(client_id, port, ingest_processes):
+    "a client always talks to the same ingest process"
+    return port + zlib.crc32(client_id.encode()) % ingest_processes
+
+
+def start_tensorplex_server(tensorplex, port, ingest_processes=1,
+                            metrics_port=None):
+    """
+    Blocks forever.
+
+    Args:
+        ingest_processes: number of processes that receive, unpickle and
+            dispatch records, listening on port, port+1, ...
+            port+ingest_processes-1. Each process routes a record straight to
+            the _WriterGroup that owns its writer. Clients must be created
+            with the same `ingest_processes`. Requires fork (Linux, macOS),
+            max_processes > 0 and no aggregated group. Relays are not
+            supported, they forward to a single port.
+        metrics_port: if not None, serve Prometheus metrics on
+            http://<host>:<metrics_port>/metrics, from a background thread.
+            With several ingest processes, each serves its own metrics on
+            metrics_port + its index.
+    """
+    sig = tensorplex._profile_signal
+    if (sig is not None
+            and threading.current_thread() is not threading.main_thread()):
+        # the signal would kill the server instead
+        raise RuntimeError('with profile_signal, start_server() must run in '
+                           'the main thread')
+    if ingest_processes == 1:
+        _serve(tensorplex, port, metrics_port)
+        return
+    tensorplex._prepare_ingest_processes()
+    ctx = mp.get_context('fork')
+    procs = []
+    if sig is not None:
+        def forward(signum, frame):
+            for proc in procs:
+                os.kill(proc.pid, signum)
+        signal.signal(sig, forward)
+        # the children inherit the mask: the signal stays pending until
+        # _serve() has installed their own handler
+        signal.pthread_sigmask(signal.SIG_BLOCK, [sig])
+    for ingest_id in range(ingest_processes):
+        # not daemon: the encoder pool of an ingest process has children
+        proc = ctx.Process(
+            target=_serve_forked,
+            args=(tensorplex, port + ingest_id, ingest_id,
+                  None if metrics_port is None else metrics_port + ingest_id),
+        )
+        proc.start()
+        procs.append(proc)
+    if sig is not None:
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, [sig])
+    for proc in procs:
+        proc.join()
+
+
+def _serve_forked(tensorplex, port, ingest_id, metrics_port):
+    tensorplex._after_fork(ingest_id)
+    _serve(tensorplex, port, metrics_port)
+
+
+def _serve(tensorplex, port, metrics_port=None):
+    sig = tensorplex._profile_signal
+    if sig is not None:
+        signal.signal(sig, tensorplex._on_profile_signal)
+        # blocked while forking, see start_tensorplex_server()
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, [sig])
+    errors = tensorplex._dispatch_errors
+    traced_methods = tensorplex._TRACED_METHODS
+    q = ZmqQueueServer(
+        port=port,
+        is_batched=True,
+        queue_obj=tensorplex._make_ingest_queue(),
+        stamp_traces=True,
+        errors=errors,
+    )
+    tensorplex._ingest_server = q
+    last_seen = {}  # client_id: time of the last record
+    if metrics_port is not None:
+        def collect():
+            metrics = MetricsText('tensorplex_')
+            add_ingest_metrics(metrics, q, last_seen)
+            tensorplex._add_metrics(metrics)
+            return metrics
+        start_metrics_server(metrics_port, collect)
     while True:
-        method_name, client_id, args, kwargs = q.dequeue()
-        tplex_method = getattr(tensorplex, method_name)
-        if client_id is None:
-            tplex_method(*args, **kwargs)
-        else:
-            tplex_method(*args, _client_id_=client_id, **kwargs)
+        try:
+            record = q.dequeue(timeout=tensorplex._PERIODIC_INTERVAL)
+        except queue.Empty:
+            _periodic(tensorplex, errors)
+            continue
+        client_id = None  # if the record is malformed
+        trace = None
+        try:
+            if len(record) == 5:  # sampled for tracing, see tracing.py
+                trace = record[4]
+                trace.append(time.time())
+                record = record[:4]
+            method_name, client_id, args, kwargs = record
+            last_seen[client_id] = time.time()
+            tplex_method = getattr(tensorplex, method_name)
+            if client_id is None:
+                tplex_method(*args, **kwargs)
+            elif trace is None or method_name not in traced_methods:
+                tplex_method(*args, _client_id_=client_id, **kwargs)
+            else:
+                tplex_method(*args, _client_id_=client_id, _trace_=trace,
+                             **kwargs)
+        except Exception as e:
+            # one bad record must not stop ingestion for everybody
+            errors.count(client_id, e)
+        _periodic(tensorplex, errors)
+
+
+def _periodic(tensorplex, errors):
+    try:
+        tensorplex._periodic()
+    except Exception as e:
+        # housekeeping is retried at the next interval, and must not stop
+        # ingestion either
+        errors.count('tensorplex', e)
 
 
 class TensorplexClient(object):
     # avoid creating the Zmq socket over and over again
     _ZMQUEUE = {}
 
-    def __init__(self, client_id, *, host, port):
-        self.zmqueue = self._get_client(host, port)
+    def __init__(self, client_id, *, host, port, precompute_histogram=False,
+                 ingest_processes=1, trace_rate=0., flush_time=0.2):
+        """
+        Args:
+            client_id: "<group>/<id>"
+            host:
+            port:
+            precompute_histogram: if True, add_histogram() computes the bucket
+                counts locally and only sends the compact summary to the server
+                instead of the full raw array.
+            ingest_processes: must match the server's, see
+                start_tensorplex_server()
+            trace_rate: fraction of the records that carry timestamps through
+                the whole pipeline, for the server's per-stage latency
+                histograms, see Tensorplex.dump_traces()
+            flush_time: records are batched and sent every flush_time seconds.
+                Clients of the same process that talk to the same server with
+                the same flush_time share a socket.
+        """
+        assert flush_time > 0, 'the server only accepts batches'
+        port = ingest_port(client_id, port, ingest_processes)
+        self.zmqueue = self._get_client(host, port, flush_time)
         self._client_id = client_id
+        self._precompute_histogram = precompute_histogram
+        self._trace_rate = trace_rate
 
-    def _get_client(self, host, port):
-        if (host, port) in self._ZMQUEUE:
-            return self._ZMQUEUE[host, port]
+    def _enqueue(self, record):
+        if self._trace_rate and random.random() < self._trace_rate:
+            trace = [time.time()]
+            self.zmqueue.enqueue(record + (trace,), trace=trace)
+        else:
+            self.zmqueue.enqueue(record)
+
+    def _get_client(self, host, port, flush_time):
+        if (host, port, flush_time) in self._ZMQUEUE:
+            return self._ZMQUEUE[host, port, flush_time]
         zmqueue = ZmqQueueClient(
             host=host,
             port=port,
-            flush_time=0.2,
+            flush_time=flush_time,
         )
-        self._ZMQUEUE[host, port] = zmqueue
+        self._ZMQUEUE[host, port, flush_time] = zmqueue
         return zmqueue
 
 
 def _wrap_method(fname, old_method):
-    if test_bind_partial(old_method, _client_id_=0):
+    # special case
+    if fname == 'add_histogram':
+        def _method(self, tag, values, global_step=None, bins='tensorflow',
+                    walltime=None, max_bins=None):
+            if self._precompute_histogram:
+                kwargs = compute_histogram(values, bins, max_bins)
+                kwargs.update(global_step=global_step, walltime=walltime)
+                self._enqueue(
+                    ('add_histogram_raw', self._client_id, (tag,), kwargs)
+                )
+            else:
+                kwargs = dict(global_step=global_step, bins=bins,
+                              walltime=walltime)
+                if max_bins is not None:
+                    kwargs['max_bins'] = max_bins
+                self._enqueue(
+                    ('add_histogram', self._client_id, (tag, values), kwargs)
+                )
+    elif fname == 'add_scalar_array':
+        def _method(self, tag, values, steps, walltimes=None):
+            values, steps, walltimes = check_scalar_array(
+                values, steps, walltimes
+            )
+            self._enqueue(
+                ('add_scalar_array', self._client_id,
+                 (tag, values, steps, walltimes), {})
+            )
+    elif test_bind_partial(old_method, _client_id_=0):
         def _method(self, *args, **kwargs):
-            self.zmqueue.enqueue(
+            self._enqueue(
                 (fname, self._client_id, args, kwargs)
             )
     else:
         def _method(self, *args, **kwargs):
-            self.zmqueue.enqueue(
+            self._enqueue(
                 (fname, None, args, kwargs)
             )
     return _method
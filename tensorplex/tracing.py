@@ -0,0 +1,108 @@
+"""
+Sampled end-to-end latency tracing.
+
+A client created with `trace_rate > 0` appends a list of timestamps to a random
+fraction of its records, (method, client_id, args, kwargs, trace). Every stage
+the record goes through appends time.time() to the list:
+    enqueue: the client method is called
+    send: the client batch thread sends the batch over ZMQ
+    receive: the server unpickles the message
+    dispatch: the server dispatch loop takes the record off the ingest queue
+    dequeue: the _WriterGroup takes the record off its queue
+    write: the _Writer has handed the event to tensorboardX
+
+The latency of a stage is the time since the previous one. Client timestamps
+come from the client host clock, so 'receive' includes the clock offset
+between the hosts. tensorboardX writes the event file from its own thread and
+flushes it every `flush_secs`, which is not measured.
+"""
+import json
+import numpy as np
+from collections import deque
+from .metrics import Histogram
+
+
+TRACE_STAGES = ['enqueue', 'send', 'receive', 'dispatch', 'dequeue', 'write']
+# stage latencies, plus end to end
+LATENCY_NAMES = TRACE_STAGES[1:] + ['total']
+LATENCY_HELP = {
+    'send': 'client batching, from enqueue to send',
+    'receive': 'network and ZMQ buffers, from client send to server receive',
+    'dispatch': 'wait in the server ingest queue',
+    'dequeue': 'routing and wait in the writer queue',
+    'write': 'writer processing, until handed to tensorboardX',
+    'total': 'end to end, from client enqueue to write',
+}
+LATENCY_BUCKETS = [1e-4, 5e-4, 1e-3, 5e-3, 1e-2, 5e-2, 0.1, 0.2, 0.5,
+                   1., 2., 5., 10., 30., 60.]
+PERCENTILES = [50, 90, 99]
+
+
+def stamp_received(records, now):
+    "server side, for every record of a received batch"
+    for record in records:
+        # malformed records are caught by the dispatch loop
+        if isinstance(record, tuple) and len(record) == 5:
+            record[4].append(now)
+
+
+class TraceStats(object):
+    """
+    Aggregates completed traces into per-stage latency histograms, cumulative
+    since the server started, and percentiles since the last
+    pop_percentiles().
+    """
+    # max latencies kept per stage between two pop_percentiles()
+    _RECENT_SIZE = 10000
+
+    def __init__(self):
+        self.num_traces = 0
+        self.histograms = {name: Histogram(LATENCY_BUCKETS)
+                           for name in LATENCY_NAMES}
+        self._recent = {name: deque(maxlen=self._RECENT_SIZE)
+                        for name in LATENCY_NAMES}
+
+    def _observe(self, name, latency):
+        self.histograms[name].observe(latency)
+        self._recent[name].append(latency)
+
+    def add(self, trace):
+        """
+        Args:
+            trace: list of timestamps, one per TRACE_STAGES
+        """
+        if len(trace) != len(TRACE_STAGES):
+            return  # malformed, e.g. sent by a client of another version
+        self.num_traces += 1
+        for i, name in enumerate(TRACE_STAGES[1:]):
+            self._observe(name, trace[i + 1] - trace[i])
+        self._observe('total', trace[-1] - trace[0])
+
+    def pop_percentiles(self):
+        """
+        Returns:
+            {latency name: list of PERCENTILES} for the traces added since
+            the last call, empty if there are none
+        """
+        percentiles = {}
+        for name, recent in self._recent.items():
+            if recent:
+                percentiles[name] = np.percentile(recent, PERCENTILES).tolist()
+                recent.clear()
+        return percentiles
+
+    def dump(self, json_path):
+        """
+        Format: {latency name: {buckets: [upper bound, ...],
+                                counts: [count per bucket, +Inf last],
+                                sum: seconds}, ...}
+        """
+        with open(json_path, 'w') as f:
+            json.dump({
+                name: {
+                    'buckets': hist.buckets,
+                    'counts': hist.counts,
+                    'sum': hist.sum,
+                }
+                for name, hist in self.histograms.items()
+            }, f, indent=2)
@@ -1,6 +1,9 @@
 import os
 import binascii
 import inspect
+import threading
+import time
+from collections import Counter
 
 
 def mkdir(fpath):
@@ -67,3 +70,45 @@ def delegate_methods(*,
             new_func.__doc__ = doc
         setattr(target_obj, fname, new_func)
 
+
+class ErrorCounter(object):
+    """
+    Counts errors per (client_id, error type), and prints at most one line per
+    key every `interval` seconds, so that a client that keeps sending bad
+    records cannot flood the server log.
+    """
+    def __init__(self, name, interval=10.):
+        """
+        Args:
+            name: prefix of the printed lines, e.g. the server name
+            interval: min seconds between two lines for the same key
+        """
+        self._name = name
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._counts = Counter()
+        self._next_print = {}  # key: time
+
+    def count(self, client_id, exc):
+        key = (str(client_id), type(exc).__name__)
+        now = time.time()
+        with self._lock:
+            self._counts[key] += 1
+            if now < self._next_print.get(key, 0.):
+                return
+            self._next_print[key] = now + self._interval
+            count = self._counts[key]
+        print('{} failed to dispatch a record from client {} ({} so far): {!r}'
+              .format(self._name, key[0], count, exc))
+
+    @property
+    def total(self):
+        return sum(self._counts.values())
+
+    def snapshot(self):
+        """
+        Returns:
+            {(client_id, error type name): cumulative count}
+        """
+        with self._lock:
+            return dict(self._counts)
@@ -1,7 +1,51 @@
 import zmq
+import pickle
 import queue
 import threading
 import time
+import zlib
+from .metrics import Histogram, DECODE_TIME_BUCKETS, BATCH_SIZE_BUCKETS
+from .tracing import stamp_received
+from .utils import ErrorCounter
+
+
+# multipart messages forwarded by relay nodes, see relay.py
+# [RELAY_FRAMES, frame, frame, ...]: each frame is a message as sent by a
+#   client, i.e. a pickled batch
+# [RELAY_ZLIB, payload]: payload is the zlib-compressed pickled list of frames
+RELAY_FRAMES = b'relay'
+RELAY_ZLIB = b'relay+zlib'
+
+
+def unpack_relay_frames(parts):
+    """
+    Args:
+        parts: multipart message, from a client (single part) or a relay
+
+    Returns:
+        list of the original client messages
+    """
+    if len(parts) == 1:
+        return parts
+    header = parts[0]
+    if header == RELAY_FRAMES:
+        return parts[1:]
+    elif header == RELAY_ZLIB:
+        return pickle.loads(zlib.decompress(parts[1]))
+    else:
+        raise ValueError('unknown relay header {!r}'.format(header))
+
+
+def pack_relay_frames(frames, compress=False):
+    """
+    Returns:
+        multipart message that carries all the frames
+    """
+    if compress:
+        payload = pickle.dumps(frames, protocol=pickle.HIGHEST_PROTOCOL)
+        return [RELAY_ZLIB, zlib.compress(payload)]
+    else:
+        return [RELAY_FRAMES] + frames
 
 
 class ZmqQueueServer(object):
@@ -13,18 +57,29 @@ class ZmqQueueServer(object):
                  is_batched,
                  maxsize=0,
                  use_pickle=True,
-                 start_thread=True):
+                 start_thread=True,
+                 queue_obj=None,
+                 stamp_traces=False,
+                 errors=None):
         """
         Args:
             max_zmq_buffer: RCVHWM, i.e. "receive high water mark" for ZMQ,
             limits interal buffered size
             https://stackoverflow.com/questions/9385249/limiting-queue-length-with-pyzmq
             http://api.zeromq.org/2-1:zmq-setsockopt
+            queue_obj: custom queue with put() and get(block, timeout),
+                e.g. a DropQueue. Overrides maxsize.
+            stamp_traces: append the receive time to the sampled records of
+                each batch, see tracing.py
+            errors: ErrorCounter for the messages and records that cannot be
+                decoded or queued, they are skipped
 
         Warnings:
             HWM doesn't behave as we intuitively expect.
         """
-        self._queue = queue.Queue(maxsize=maxsize)
+        if queue_obj is None:
+            queue_obj = queue.Queue(maxsize=maxsize)
+        self._queue = queue_obj
         context = zmq.Context()
         self.socket = context.socket(zmq.PULL)
         # TODO use router-dealer pattern to stall the sender when recv is full
@@ -35,6 +90,16 @@ class ZmqQueueServer(object):
         self.socket.bind("tcp://*:{}".format(port))
         self._use_pickle = use_pickle
         self._is_batched = is_batched
+        self._stamp_traces = stamp_traces
+        if errors is None:
+            errors = ErrorCounter('ZmqQueueServer')
+        self._errors = errors
+        # cumulative, for server metrics
+        self.num_messages = 0
+        self.num_records = 0
+        self.num_bytes = 0
+        self.decode_time = Histogram(DECODE_TIME_BUCKETS)
+        self.batch_size = Histogram(BATCH_SIZE_BUCKETS)
 
         self.enqueue_thread = None
         if start_thread:
@@ -49,21 +114,59 @@ class ZmqQueueServer(object):
         return self.enqueue_thread
 
     def _run_enqueue(self):
+        # a malformed message must not stop the receive thread: the client ID
+        # is unknown at this point, errors are counted for client None
         while True:
-            if self._use_pickle:
-                obj = self.socket.recv_pyobj()
-            else:
-                obj = self.socket.recv()
-            if self._is_batched:
-                assert isinstance(obj, list)
-                for ob in obj:
-                    self._queue.put(ob)
-            else:
-                self._queue.put(obj)
+            parts = self.socket.recv_multipart()
+            try:
+                # clients send one part, relay nodes send many clients at once
+                frames = unpack_relay_frames(parts)
+            except Exception as e:
+                self._errors.count(None, e)
+                continue
+            for frame in frames:
+                self.num_messages += 1
+                self.num_bytes += len(frame)
+                try:
+                    obj = self._decode(frame)
+                except Exception as e:
+                    self._errors.count(None, e)
+                    continue
+                if self._is_batched:
+                    self.num_records += len(obj)
+                    self.batch_size.observe(len(obj))
+                    if self._stamp_traces:
+                        stamp_received(obj, time.time())
+                    for ob in obj:
+                        self._put(ob)
+                else:
+                    self.num_records += 1
+                    self._put(obj)
+
+    def _decode(self, frame):
+        if self._use_pickle:
+            start = time.perf_counter()
+            obj = pickle.loads(frame)
+            self.decode_time.observe(time.perf_counter() - start)
+        else:
+            obj = frame
+        if self._is_batched and not isinstance(obj, list):
+            raise TypeError('expected a batch (list), got '
+                            + type(obj).__name__)
+        return obj
+
+    def _put(self, obj):
+        try:
+            self._queue.put(obj)
+        except Exception as e:  # e.g. a DropQueue that cannot classify obj
+            self._errors.count(None, e)
 
     def dequeue(self, timeout=None):
         return self._queue.get(block=True, timeout=timeout)
 
+    def qsize(self):
+        return self._queue.qsize()
+
 
 class ZmqQueueClient(object):
     def __init__(self,
@@ -85,7 +188,13 @@ class ZmqQueueClient(object):
         else:
             self._send = self.socket.send
         self._batch_buffer = []
+        self._batch_traces = []  # of the records in _batch_buffer
         self._batch_lock = threading.Lock()
+        self._num_in_flight = 0  # records of the batch being sent
+        # cumulative, for load generators: server backpressure shows as time
+        # blocked in send() once the ZMQ high water mark is reached
+        self.num_sent = 0
+        self.send_seconds = 0.
 
         self.batch_thread = None
         if self._flush_time > 0 and start_thread:
@@ -102,15 +211,46 @@ class ZmqQueueClient(object):
     def _run_batch(self):
         while True:
             if self._batch_buffer:
+                # send without the lock: enqueue() must not wait for a send
+                # blocked by the server, the buffer grows instead
+                with self._batch_lock:
+                    batch = self._batch_buffer
+                    traces = self._batch_traces
+                    self._batch_buffer = []
+                    self._batch_traces = []
+                    self._num_in_flight = len(batch)
+                now = time.time()
+                for trace in traces:
+                    trace.append(now)
+                self._timed_send(batch, len(batch))
                 with self._batch_lock:
-                    self._send(self._batch_buffer)
-                    self._batch_buffer.clear()
+                    self._num_in_flight = 0
             time.sleep(self._flush_time)
 
-    def enqueue(self, obj):
+    def _timed_send(self, obj, num_records):
+        start = time.perf_counter()
+        self._send(obj)
+        self.send_seconds += time.perf_counter() - start
+        self.num_sent += num_records
+
+    def backlog(self):
+        "number of records enqueued but not sent yet"
+        with self._batch_lock:
+            return len(self._batch_buffer) + self._num_in_flight
+
+    def enqueue(self, obj, trace=None):
+        """
+        Args:
+            trace: list of timestamps carried by obj, the send time is
+                appended to it, see tracing.py
+        """
         if self._flush_time == 0:  # no batching
-            self._send(obj)
+            if trace is not None:
+                trace.append(time.time())
+            self._timed_send(obj, 1)
         else:
             with self._batch_lock:
                 self._batch_buffer.append(obj)
+                if trace is not None:
+                    self._batch_traces.append(trace)
 
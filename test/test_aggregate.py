@@ -0,0 +1,62 @@
+from tensorplex.aggregate import StepAggregator, reduce_values
+
+
+def _steps(completed):
+    return [(tag, step) for tag, step, _ in completed]
+
+
+def test_reduce_values():
+    stats = reduce_values([1., 2., 3., 4., 5.])
+    assert stats['mean'] == 3.
+    assert stats['median'] == 3.
+
+
+def test_complete_step_is_emitted_once_members_are_stable():
+    agg = StepAggregator(window=10.)
+    assert agg.add('0', 'r', 1, 1., now=0.) == []
+    assert agg.add('1', 'r', 1, 3., now=0.) == []
+    # members are stable after the window, the next complete step is emitted
+    assert agg.add('0', 'r', 2, 1., now=11.) == [
+        ('r', 1, reduce_values([1., 3.]))
+    ]
+    completed = agg.add('1', 'r', 2, 3., now=11.)
+    assert _steps(completed) == [('r', 2)]
+
+
+def test_out_of_order_steps_are_not_dropped():
+    drops = []
+    agg = StepAggregator(window=10., on_drop=lambda *args: drops.append(args))
+    agg.add('0', 'r', 100, 1., now=0.)
+    agg.add('1', 'r', 100, 1., now=20.)
+    # step 60 was never reduced, even though step 100 was
+    completed = agg.add('0', 'r', 60, 2., now=31.)
+    completed += agg.add('1', 'r', 60, 4., now=31.)
+    assert completed == [('r', 60, reduce_values([2., 4.]))]
+    assert drops == []
+
+
+def test_late_value_for_reduced_step_is_dropped_and_counted():
+    drops = []
+    agg = StepAggregator(window=10., on_drop=lambda *args: drops.append(args))
+    agg.add('0', 'r', 5, 1., now=0.)
+    assert _steps(agg.expire(now=10.)) == [('r', 5)]
+    assert agg.add('1', 'r', 5, 2., now=11.) == []
+    assert drops == [('1', 'r')]
+    assert agg.flush() == []
+    # another tag with the same step is a different reduction
+    agg.add('1', 'other', 5, 2., now=11.)
+    assert _steps(agg.flush()) == [('other', 5)]
+
+
+def test_reduced_keys_are_bounded():
+    drops = []
+    agg = StepAggregator(window=1., max_reduced=3,
+                         on_drop=lambda *args: drops.append(args))
+    for step in range(5):
+        agg.add('0', 'r', step, 1., now=0.)
+    assert len(agg.flush()) == 5
+    assert len(agg._reduced) == 3
+    agg.add('0', 'r', 4, 1., now=0.)  # remembered
+    assert drops == [('0', 'r')]
+    agg.add('0', 'r', 0, 1., now=0.)  # forgotten, reduced again
+    assert _steps(agg.flush()) == [('r', 0)]
@@ -0,0 +1,165 @@
+import queue
+import random
+import pytest
+from tensorplex.drop_queue import (DropQueue, Barrier, record_lane,
+                                   get_overflow_policy, RECORD_PRIORITY,
+                                   FAST_LANE, HEAVY_LANE)
+
+
+def _kind(item):
+    # like the records of the system writer, control items have no kind
+    return None if item[0] == 'control' else item[0]
+
+
+def _lane(item):
+    return record_lane(item[0])
+
+
+def _drain(q):
+    items = []
+    while True:
+        try:
+            items.append(q.get_nowait())
+        except queue.Empty:
+            return items
+
+
+def test_fast_lane_first_with_starvation_limit():
+    q = DropQueue(0, _kind, lane_fn=_lane, starvation_limit=2)
+    for i in range(3):
+        q.put(('add_image', i))
+    for i in range(6):
+        q.put(('add_scalar', i))
+    assert q.lane_sizes() == [6, 3]
+    order = [item[0] for item in _drain(q)]
+    assert order == ['add_scalar', 'add_scalar', 'add_image'] * 3
+
+
+def test_barrier_waits_for_every_lane():
+    q = DropQueue(0, _kind, lane_fn=_lane)
+    q.put(('add_image', 0))
+    q.put(('add_scalar', 0))
+    q.put(('export', 0))  # not a record: barrier
+    q.put(('add_scalar', 1))
+    assert _drain(q) == [('add_scalar', 0), ('add_image', 0),
+                         ('export', 0), ('add_scalar', 1)]
+    assert q.qsize() == 0
+
+
+def test_barrier_copies_in_different_orders():
+    q = DropQueue(0, _kind, lane_fn=_lane)
+    b1, b2 = Barrier('b1'), Barrier('b2')
+    q.put(('add_scalar', 0))
+    q.put(b1, lane=FAST_LANE)
+    q.put(b2, lane=FAST_LANE)
+    q.put(('add_scalar', 1))
+    q.put(b2, lane=HEAVY_LANE)
+    q.put(b1, lane=HEAVY_LANE)
+    q.put(('add_image', 0))
+    # every barrier comes out once, and before the records that follow it
+    assert _drain(q) == [('add_scalar', 0), 'b1', 'b2',
+                         ('add_scalar', 1), ('add_image', 0)]
+    assert q.qsize() == 0 and q.lane_sizes() == [0, 0]
+
+
+@pytest.mark.parametrize('policy', ['drop_oldest', 'drop_low_priority'])
+def test_eviction_does_not_scan_the_queue(policy):
+    calls = [0]
+
+    def kind_fn(item):
+        calls[0] += 1
+        return item[0]
+
+    size = 10000
+    dropped = []
+    q = DropQueue(size, kind_fn, overflow_policy=policy,
+                  on_drop=dropped.append)
+    for i in range(size - 1):
+        q.put(('add_scalar', i))
+    q.put(('add_image', 0))
+    calls[0] = 0
+    assert q.put(('add_scalar', size))
+    assert calls[0] == 1
+    if policy == 'drop_oldest':
+        assert dropped == [('add_scalar', 0)]
+    else:
+        assert dropped == [('add_image', 0)]
+    items = _drain(q)
+    assert len(items) == size and dropped[0] not in items
+
+
+def test_no_kind_always_blocks():
+    dropped = []
+    q = DropQueue(1, _kind, overflow_policy='drop_newest',
+                  on_drop=dropped.append)
+    q.put(('control', 0))
+    with pytest.raises(queue.Full):
+        q.put(('control', 1), block=False)
+    assert not q.put(('add_scalar', 0))
+    assert dropped == [('add_scalar', 0)]
+
+
+@pytest.mark.parametrize('seed', range(100))
+def test_random_puts_and_gets_keep_the_invariants(seed):
+    """
+    Checked against a model of the queued items of every lane: items come out
+    in FIFO order within their lane, every dropped item is reported once, and
+    an eviction removes the oldest item the policy allows.
+    """
+    rng = random.Random(seed)
+    kinds = ['add_scalar', 'add_text', 'add_histogram', 'add_image',
+             'add_audio', 'control']
+    policy = rng.choice([
+        'drop_oldest', 'drop_low_priority', 'drop_newest',
+        {'add_scalar': 'drop_low_priority', 'add_image': 'drop_oldest'},
+    ])
+    maxsize = rng.randint(1, 6)
+    dropped = []
+    q = DropQueue(maxsize, _kind, overflow_policy=policy,
+                  on_drop=dropped.append, lane_fn=_lane)
+
+    def lane_of(item):
+        return FAST_LANE if item[0] == 'control' else _lane(item)
+
+    model = {FAST_LANE: [], HEAVY_LANE: []}
+    for i in range(300):
+        if rng.random() < 0.55:
+            item = (rng.choice(kinds), i)
+            lane = lane_of(item)
+            queued = model[lane]
+            kind_policy = get_overflow_policy(policy, _kind(item))
+            if kind_policy == 'block' and len(queued) == maxsize:
+                with pytest.raises(queue.Full):
+                    q.put(item, block=False, lane=lane)
+                continue
+            kept = q.put(item, block=False, lane=lane)
+            if len(queued) < maxsize:
+                eligible = []
+            elif kind_policy == 'drop_oldest':
+                eligible = [x for x in queued if x[0] == item[0]]
+            elif kind_policy == 'drop_low_priority':
+                priority = RECORD_PRIORITY[item[0]]
+                eligible = [x for x in queued
+                            if RECORD_PRIORITY.get(x[0], 2) < priority]
+            else:  # drop_newest
+                eligible = []
+            if len(queued) < maxsize:
+                assert kept and not dropped
+            elif eligible:
+                assert kept and dropped == [eligible[0]]
+                queued.remove(eligible[0])
+            else:
+                assert not kept and dropped == [item]
+            if kept:
+                queued.append(item)
+            del dropped[:]
+        else:
+            try:
+                item = q.get_nowait()
+            except queue.Empty:
+                assert not model[FAST_LANE] and not model[HEAVY_LANE]
+                continue
+            assert model[lane_of(item)].pop(0) == item
+        assert q.lane_sizes() == [len(model[FAST_LANE]),
+                                  len(model[HEAVY_LANE])]
+        assert q.qsize() == len(model[FAST_LANE]) + len(model[HEAVY_LANE])
@@ -0,0 +1,60 @@
+import json
+import os
+import numpy as np
+from tensorboardX import SummaryWriter
+from tensorplex.export import export_json, export_npz, export_scalars
+
+
+def _write_scalars(folder, scalars):
+    "scalars: list of (tag, value, step)"
+    writer = SummaryWriter(folder)
+    for tag, value, step in scalars:
+        writer.add_scalar(tag, value, step)
+    writer.add_histogram('not_a_scalar', np.arange(10), 0)
+    writer.close()
+
+
+def test_export_json_reads_every_scalar(tmp_path):
+    folder = str(tmp_path / 'writer')
+    scalars = [('loss', 0.5, 0), ('loss', 0.25, 1), ('reward', 1., 0)]
+    _write_scalars(folder, scalars)
+    path = str(tmp_path / 'out.json')
+    export_json(folder, path)
+    with open(path) as f:
+        exported = json.load(f)
+    assert sorted(exported) == ['loss', 'reward']
+    assert [(step, value) for _, step, value in exported['loss']] == \
+        [(0, 0.5), (1, 0.25)]
+    assert [(step, value) for _, step, value in exported['reward']] == \
+        [(0, 1.)]
+
+
+def test_export_npz_round_trip(tmp_path):
+    folder = str(tmp_path / 'writer')
+    scalars = [('loss', 0.5 / (i + 1), i) for i in range(7)]
+    scalars += [('reward/episode', float(i), 10 * i) for i in range(3)]
+    _write_scalars(folder, scalars)
+    path = str(tmp_path / 'out.npz')
+    export_scalars(folder, path, 'agent/0', 'npz', chunk_size=3)
+    with np.load(path) as data:
+        assert sorted(data.files) == \
+            ['step', 'tag', 'value', 'wall_time', 'writer']
+        assert data['writer'].tolist() == ['agent/0'] * len(scalars)
+        assert data['step'].dtype == np.int64
+        rows = list(zip(data['tag'].tolist(), data['value'].tolist(),
+                        data['step'].tolist()))
+        assert sorted(rows) == \
+            sorted((tag, float(np.float32(value)), step)
+                   for tag, value, step in scalars)
+        assert (data['wall_time'] > 0).all()
+    # the temporary spool files are gone
+    assert sorted(os.listdir(str(tmp_path))) == ['out.npz', 'writer']
+
+
+def test_export_npz_no_scalars(tmp_path):
+    folder = str(tmp_path / 'writer')
+    _write_scalars(folder, [])
+    path = str(tmp_path / 'out.npz')
+    export_npz(folder, path, 'agent/0', chunk_size=3)
+    with np.load(path) as data:
+        assert all(len(data[name]) == 0 for name in data.files)
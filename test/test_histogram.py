@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+from tensorboardX import SummaryWriter
+from tensorboardX.summary import make_histogram
+from tensorplex.histogram import compute_histogram, default_bins
+
+
+def _assert_same(hist, proto):
+    assert hist['min'] == proto.min
+    assert hist['max'] == proto.max
+    assert hist['num'] == proto.num
+    assert hist['sum'] == pytest.approx(proto.sum)
+    assert hist['sum_squares'] == pytest.approx(proto.sum_squares)
+    assert hist['bucket_limits'] == list(proto.bucket_limit)
+    assert hist['bucket_counts'] == list(proto.bucket)
+
+
+def test_default_bins(tmp_path):
+    writer = SummaryWriter(str(tmp_path))
+    np.testing.assert_array_equal(default_bins(), writer.default_bins)
+    writer.close()
+
+
+@pytest.mark.parametrize('bins, max_bins', [
+    ('tensorflow', None),
+    ('tensorflow', 50),
+    (10, None),
+    ('auto', 7),
+    (np.linspace(-3, 3, 13), 5),
+])
+@pytest.mark.parametrize('seed', range(3))
+def test_same_as_make_histogram(bins, max_bins, seed):
+    values = np.random.RandomState(seed).normal(size=(40, 25))
+    hist = compute_histogram(values, bins=bins, max_bins=max_bins)
+    if isinstance(bins, str) and bins == 'tensorflow':
+        bins = default_bins()
+    _assert_same(hist, make_histogram(values, bins, max_bins))
+
+
+def test_constant_and_int_values():
+    values = [3] * 5
+    hist = compute_histogram(values, bins=4)
+    _assert_same(hist, make_histogram(np.array(values, dtype=np.float64), 4))
+    assert sum(hist['bucket_counts']) == 5
+
+
+def test_no_element():
+    with pytest.raises(ValueError):
+        compute_histogram([])
@@ -0,0 +1,45 @@
+import queue
+import threading
+import time
+from tensorplex.drop_queue import Barrier, NUM_LANES
+from tensorplex.local_tensorplex import _ProcessPool
+
+
+class _GatedQueue(object):
+    "stands for an mp.Queue lane that is full for `item` until `gate` is set"
+    def __init__(self, item=None):
+        self.items = []
+        self.item = item
+        self.gate = threading.Event()
+        self.first_put = threading.Event()
+
+    def put(self, item, block=True, timeout=None):
+        if item.item == self.item and not self.gate.is_set():
+            if timeout is not None:
+                time.sleep(timeout)
+            raise queue.Full
+        self.items.append(item)
+        self.first_put.set()
+
+
+def test_barrier_copies_never_cross(tmp_path):
+    pool = _ProcessPool(str(tmp_path), max_processes=1)
+    pool._supervised = False  # no process behind the queues
+    lanes = [_GatedQueue(), _GatedQueue('export')]
+    assert len(lanes) == NUM_LANES
+    pool._proc_queues = [lanes]
+    export = threading.Thread(target=pool._put_barrier, args=(0, 'export'))
+    export.start()
+    assert lanes[0].first_put.wait(5)
+    # the heavy lane is full for the export, which waits with a copy on the
+    # fast lane while another thread registers a writer
+    add_writer = threading.Thread(target=pool._put_barrier,
+                                  args=(0, 'add_writer'))
+    add_writer.start()
+    time.sleep(3 * pool._PUT_TIMEOUT)
+    lanes[1].gate.set()
+    export.join(5)
+    add_writer.join(5)
+    for lane in lanes:
+        assert all(isinstance(item, Barrier) for item in lane.items)
+        assert [b.item for b in lane.items] == ['export', 'add_writer']
@@ -0,0 +1,28 @@
+import threading
+import zmq
+from tensorplex.relay import ZmqRelay
+from tensorplex.zmq_queue import unpack_relay_frames, RELAY_ZLIB
+
+PORT = 18971
+UPSTREAM_PORT = 18972
+
+
+def test_relay_skips_malformed_messages():
+    context = zmq.Context()
+    upstream = context.socket(zmq.PULL)
+    upstream.bind('tcp://*:{}'.format(UPSTREAM_PORT))
+    upstream.setsockopt(zmq.RCVTIMEO, 5000)
+    relay = ZmqRelay(PORT, 'localhost', UPSTREAM_PORT, flush_time=0.05)
+    thread = threading.Thread(target=relay.run)
+    thread.daemon = True
+    thread.start()
+    sender = context.socket(zmq.PUSH)
+    sender.connect('tcp://127.0.0.1:{}'.format(PORT))
+    sender.send_multipart([b'bad header', b'payload'])
+    sender.send_multipart([RELAY_ZLIB, b'not zlib'])
+    sender.send(b'good')
+    assert unpack_relay_frames(upstream.recv_multipart()) == [b'good']
+    assert relay.errors.total == 2
+    assert thread.is_alive()
+    sender.close(linger=0)
+    upstream.close(linger=0)
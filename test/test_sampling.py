@@ -0,0 +1,82 @@
+import random
+import numpy as np
+import pytest
+from tensorplex.sampling import SamplingRule, Sampler, _SamplerState
+
+
+def test_keep_every_k():
+    state = _SamplerState(SamplingRule(every_k=3))
+    assert [state.keep(step, 0., 0.) for step in range(7)] == \
+        [True, False, False, True, False, False, True]
+    # records without a step are counted
+    assert [state.keep(None, 0., 0.) for _ in range(4)] == \
+        [True, False, False, True]
+
+
+def test_keep_mask_every_k_on_change_max_points():
+    rule = SamplingRule(every_k=2, on_change=True, max_points=2, interval=10.)
+    state = _SamplerState(rule)
+    steps = np.arange(8)
+    values = np.array([1., 5., 1., 5., 2., 5., 3., 5.])
+    # every_k: 0, 2, 4, 6. on_change: 1, 1 -> 0, 4, 6. max_points: 0, 4
+    assert state.keep_mask(steps, values, 0.).tolist() == \
+        [True, False, False, False, True, False, False, False]
+    assert state.last_value == 2.
+    # the window is full until `interval` has passed
+    assert not state.keep_mask(steps + 8, values + 10, 5.).any()
+    mask = state.keep_mask(np.array([8, 10]), np.array([2., 7.]), 10.)
+    assert mask.tolist() == [False, True]
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_keep_mask_matches_keep(seed):
+    rng = random.Random(seed)
+    rule = SamplingRule(
+        every_k=rng.choice([None, 1, 2, 3]),
+        on_change=rng.random() < 0.5,
+        **rng.choice([{}, {'max_points': rng.randint(1, 20), 'interval': 3.}])
+    )
+    scalar_state = _SamplerState(rule)
+    array_state = _SamplerState(rule)
+    step = 0
+    for now in range(10):
+        n = rng.randint(0, 15)
+        steps = np.arange(step, step + n)
+        values = np.array([float(rng.randint(0, 2)) for _ in range(n)])
+        step += n
+        expected = [scalar_state.keep(s, v, float(now))
+                    for s, v in zip(steps.tolist(), values.tolist())]
+        mask = array_state.keep_mask(steps, values, float(now))
+        assert mask.tolist() == expected
+        assert array_state.last_value == scalar_state.last_value
+        assert array_state.window_start == scalar_state.window_start
+        assert array_state.window_count == scalar_state.window_count
+
+
+def test_first_matching_rule_applies():
+    sampler = Sampler()
+    assert not sampler.active
+    sampler.add_rule(SamplingRule(group='train', tag='loss*', every_k=10))
+    sampler.add_rule(SamplingRule(group='train', every_k=2))
+    assert sampler.active
+    assert sampler.get_state('train/0', 'loss/total').rule.every_k == 10
+    assert sampler.get_state('train/0', 'accuracy').rule.every_k == 2
+    assert sampler.get_state('eval/0', 'loss/total') is None
+
+
+def test_state_cache():
+    sampler = Sampler()
+    sampler._STATE_CACHE_SIZE = 4
+    sampler.add_rule(SamplingRule(every_k=2))
+    state = sampler.get_state('a/0', 'x')
+    assert sampler.get_state('a/0', 'x') is state
+    for i in range(3):
+        sampler.get_state('a/0', str(i))
+    assert len(sampler._states) == 4
+    sampler.get_state('a/0', 'y')  # full: cleared first
+    assert len(sampler._states) == 1
+    assert sampler.get_state('a/0', 'x') is not state
+    # a new rule can change the lookup of cached tags
+    sampler.add_rule(SamplingRule(tag='x', every_k=5))
+    assert not sampler._states
+    assert sampler.get_state('a/0', 'x').rule.every_k == 2
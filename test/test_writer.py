@@ -0,0 +1,34 @@
+from tensorplex.export import event_files
+from tensorplex.local_tensorplex import _Writer
+
+
+def _fill(writer, n):
+    for step in range(n):
+        writer.writer.add_scalar('loss', 1., step)
+    writer.writer.flush()
+
+
+def test_rotate_bytes(tmp_path):
+    writer = _Writer(str(tmp_path), 'w', rotate_bytes=1000)
+    files = event_files(writer.folder)
+    assert files == [writer._event_file]
+    writer._maybe_rotate()
+    assert len(event_files(writer.folder)) == 1
+    _fill(writer, 100)
+    assert writer._event_file_size() >= 1000
+    writer._next_rotate_check = 0.
+    writer._maybe_rotate()
+    files = event_files(writer.folder)
+    assert len(files) == 2 and writer._event_file in files
+    assert writer._event_file_size() < 1000
+    writer.writer.close()
+
+
+def test_event_file_fallback_warns_once(tmp_path, capsys):
+    writer = _Writer(str(tmp_path), 'w', rotate_bytes=1000)
+    _fill(writer, 100)
+    writer._event_file = None
+    assert writer._event_file_size() >= 1000
+    assert writer._event_file_size() >= 1000
+    assert capsys.readouterr().out.count('cannot tell') == 1
+    writer.writer.close()